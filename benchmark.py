@@ -0,0 +1,310 @@
+"""Offline benchmarks for the upload and search pipelines.
+
+Runs against a fake Gemini client, the local vector store and synthetic images in a
+scratch directory, so nothing leaves the machine. CLIP is a tiny randomly initialised
+stand-in by default (--clip tiny) which measures pipeline overhead; --clip real uses
+the cached ViT-B/32 weights for end-to-end numbers.
+
+    python benchmark.py --images 64 --concurrency 8 --requests 200 --output bench_output.json
+    python benchmark.py --baseline bench_output.json   # compare against an earlier run
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+_process_started = time.perf_counter()
+
+REPO_DIR = Path(__file__).resolve().parent
+PHRASES = ["a dog on the beach", "sunset over mountains", "birthday cake with candles", "city street at night",
+           "children playing football", "a cat sleeping on a sofa", "snowy forest", "plate of pasta"]
+
+
+def _peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        "count": len(samples),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 2),
+        "p50_ms": round(pick(0.50) * 1000, 2),
+        "p95_ms": round(pick(0.95) * 1000, 2),
+        "p99_ms": round(pick(0.99) * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2),
+    }
+
+
+def _configure_env(workdir):
+    """Points every store at workdir; must run before any repo module is imported"""
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+    for name in ("photos/all", "photos/recent"):
+        Path(name).mkdir(parents=True, exist_ok=True)
+    os.environ.setdefault("GEMINI_API_KEY", "offline")
+    os.environ.setdefault("PINECONE_API_KEY", "offline")
+    os.environ.setdefault("SECRET_KEY", "offline")
+    os.environ["VECTOR_STORE_BACKEND"] = "local"
+    os.environ["LOCAL_INDEX_DIR"] = str(Path(workdir) / "index")
+    os.environ["FEATURE_CACHE_DIR"] = str(Path(workdir) / "cache")
+    os.environ["RESUME_ON_STARTUP"] = "0"
+    os.environ.setdefault("CAPTION_REQUESTS_PER_MINUTE", "100000")
+    if str(REPO_DIR) not in sys.path:
+        sys.path.insert(0, str(REPO_DIR))
+
+
+class FakeGeminiClient:
+    """Stands in for genai.Client: returns two captions per image after `latency` seconds"""
+
+    def __init__(self, latency=0.0):
+        self.models = self
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, model, contents):
+        with self._lock:
+            self.calls += 1
+            n = self.calls
+        if self.latency:
+            time.sleep(self.latency)
+        phrase = PHRASES[n % len(PHRASES)]
+        return SimpleNamespace(text=json.dumps({"captions": [phrase, f"photo number {n}"]}))
+
+
+class _TinyClipProcessor:
+    """Character-level tokenizer plus the real CLIP image processor at 32px"""
+
+    def __init__(self):
+        from transformers import CLIPImageProcessor
+        self.image_processor = CLIPImageProcessor(size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32})
+
+    def __call__(self, text=None, images=None, return_tensors="pt", padding=True):
+        import torch
+        out = {}
+        if text is not None:
+            text = [text] if isinstance(text, str) else text
+            tokens = [[1] + [3 + ord(c) % 90 for c in t][:30] + [2] for t in text]
+            width = max(map(len, tokens))
+            out["input_ids"] = torch.tensor([t + [2] * (width - len(t)) for t in tokens])
+            out["attention_mask"] = torch.tensor([[1] * len(t) + [0] * (width - len(t)) for t in tokens])
+        if images is not None:
+            out["pixel_values"] = self.image_processor(images=images, return_tensors="pt")["pixel_values"]
+        return out
+
+
+def _install_clip(kind):
+    if kind != "tiny":
+        return
+    import torch
+    from transformers import CLIPConfig, CLIPModel
+    from config import EMBEDDING_DIM
+    from model_registry import register_clip_model
+    torch.manual_seed(0)
+    config = CLIPConfig(
+        text_config=dict(vocab_size=100, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=2, max_position_embeddings=40, bos_token_id=1, eos_token_id=2, pad_token_id=2),
+        vision_config=dict(hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=2,
+                           image_size=32, patch_size=8),
+        projection_dim=EMBEDDING_DIM)
+    register_clip_model(CLIPModel(config).eval(), _TinyClipProcessor())
+
+
+def _synthetic_images(n, width, height, seed=0):
+    """Noise JPEGs (compress like photos rather than flat colour) with a few EXIF-rotated ones"""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    for i in range(n):
+        pixels = rng.integers(0, 256, size=(height // 8, width // 8, 3), dtype=np.uint8)
+        img = Image.fromarray(pixels).resize((width, height), Image.BILINEAR)
+        buffer = io.BytesIO()
+        exif = Image.Exif()
+        if i % 5 == 0:
+            exif[0x0112] = 6
+        img.save(buffer, "JPEG", quality=90, exif=exif)
+        yield f"synthetic_{i}.jpg", buffer.getvalue()
+
+
+def bench_upload(args):
+    """One ingestion job of args.images images through every UploadPipeline stage"""
+    from ingestion_jobs import IngestionJob, run_job
+    from upload_pipeline import UploadPipeline
+
+    images = list(_synthetic_images(args.images, args.width, args.height))
+    files = [SimpleNamespace(filename=name, file=io.BytesIO(data)) for name, data in images]
+    job = IngestionJob(Path("photos/recent"), Path("photos/all"))
+    start = time.perf_counter()
+    job.start_stage("store", total=len(files))
+    UploadPipeline(job.temp_dir, job.persist_dir, job_id=job.id).store_images(files)
+    job.finish_stage("store", done=len(files))
+    run_job(job)
+    seconds = time.perf_counter() - start
+    return {
+        "images": len(images),
+        "input_mb": round(sum(len(data) for _, data in images) / 2 ** 20, 2),
+        "seconds": round(seconds, 3),
+        "images_per_sec": round(len(images) / seconds, 2),
+        "stages": {stage: entry["seconds"] for stage, entry in job.stages.items()},
+        "image_errors": len(job.image_errors),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def bench_search(client, args, distinct):
+    """args.requests POSTs to /search-endpoint from args.concurrency threads.
+    distinct=True makes every phrase unique so no request is served from the query caches"""
+    def _one(i):
+        phrase = f"{PHRASES[i % len(PHRASES)]} {i}" if distinct else PHRASES[i % len(PHRASES)]
+        start = time.perf_counter()
+        response = client.post("/search-endpoint", json={"search_phrase": phrase, "k": args.k})
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = list(pool.map(_one, range(args.requests)))
+    seconds = time.perf_counter() - start
+    return {
+        "concurrency": args.concurrency,
+        "requests_per_sec": round(len(latencies) / seconds, 2),
+        "latency": _percentiles(latencies),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def bench_cold_start(args):
+    """Times a fresh process from interpreter start to its first answered search"""
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--cold-start-probe", "--clip", args.clip]
+    started = time.perf_counter()
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True, env=os.environ.copy()).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["wall_seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def cold_start_probe(args):
+    import main
+    imported = time.perf_counter()
+    from fastapi.testclient import TestClient
+    import helpers
+    helpers.client = FakeGeminiClient()
+    # the stand-in model is built after the import so import_seconds only covers the app
+    _install_clip(args.clip)
+    with TestClient(main.app) as client:
+        client.get("/").raise_for_status()
+        while client.get("/ready").status_code == 503:
+            time.sleep(0.01)
+        ready = time.perf_counter()
+        client.post("/search-endpoint", json={"search_phrase": PHRASES[0], "k": 5}).raise_for_status()
+        answered = time.perf_counter()
+    print(json.dumps({
+        "import_seconds": round(imported - _process_started, 3),
+        "startup_seconds": round(ready - imported, 3),
+        "first_search_seconds": round(answered - ready, 3),
+        "total_seconds": round(answered - _process_started, 3),
+        "peak_rss_mb": _peak_rss_mb(),
+    }))
+
+
+def _environment(args):
+    import torch
+    try:
+        commit = subprocess.run(["git", "-C", str(REPO_DIR), "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "git_commit": commit,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "cold_start_probe")},
+    }
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(results, baseline):
+    """Prints every numeric metric next to its value in an earlier run"""
+    before = dict(_flatten(baseline["results"]))
+    for name, value in _flatten(results["results"]):
+        if name in before and before[name]:
+            change = (value - before[name]) / abs(before[name]) * 100
+            print(f"{name:55s} {before[name]:>12} -> {value:>12} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--caption-latency-ms", type=float, default=200, help="simulated Gemini round trip")
+    parser.add_argument("--clip", choices=("tiny", "real"), default="tiny")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--skip-cold-start", action="store_true")
+    parser.add_argument("--workdir", help="scratch directory (a fresh temp dir by default)")
+    parser.add_argument("--output", default=str(REPO_DIR / "bench_output.json"))
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    parser.add_argument("--cold-start-probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_start_probe:
+        _configure_env(os.getcwd())
+        cold_start_probe(args)
+        return
+
+    args.output = os.path.abspath(args.output)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="image-retriever-bench-")
+    _configure_env(workdir)
+    _install_clip(args.clip)
+    import helpers
+    helpers.client = FakeGeminiClient(latency=args.caption_latency_ms / 1000)
+    import main as app_module
+    from fastapi.testclient import TestClient
+
+    results = {}
+    with TestClient(app_module.app) as client:
+        while client.get("/ready").status_code == 503:
+            time.sleep(0.01)
+        results["upload"] = bench_upload(args)
+        results["search_uncached"] = bench_search(client, args, distinct=True)
+        results["search_cached"] = bench_search(client, args, distinct=False)
+    if not args.skip_cold_start:
+        results["cold_start"] = bench_cold_start(args)
+
+    report = {"environment": _environment(args), "workdir": workdir, "results": results}
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        compare(report, json.loads(Path(args.baseline).read_text()))
+
+
+if __name__ == "__main__":
+    main()
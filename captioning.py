@@ -0,0 +1,116 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from PIL import Image
+
+from prompts import CAPTIONING_PROMPT_BETA
+from parsers import json_parser
+from metrics import GEMINI_REQUESTS_TOTAL, GEMINI_RETRIES_TOTAL
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `requests_per_minute` calls, with bursts up to `burst`"""
+    def __init__(self, requests_per_minute, burst=None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst or max(1, int(requests_per_minute // 60))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CaptioningError(Exception):
+    pass
+
+
+def _status_code(exc):
+    """HTTP status of a google-genai APIError (or anything shaped like one)"""
+    for attr in ("code", "status_code"):
+        code = getattr(exc, attr, None)
+        if isinstance(code, int):
+            return code
+    return None
+
+
+def _is_retryable(exc):
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    return _status_code(exc) in RETRYABLE_STATUS_CODES
+
+
+def caption_image(client, img, model_name, bucket=None, max_retries=4, backoff_base=1.0, backoff_cap=30.0):
+    """Captions one image, retrying 429/5xx with exponential backoff and jitter"""
+    attempt = 0
+    while True:
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            response = client.models.generate_content(
+                model = model_name,
+                contents = [img, CAPTIONING_PROMPT_BETA]
+            )
+            GEMINI_REQUESTS_TOTAL.inc(result="ok")
+            break
+        except Exception as e:
+            GEMINI_REQUESTS_TOTAL.inc(result="error")
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            GEMINI_RETRIES_TOTAL.inc(status=_status_code(e) or type(e).__name__)
+            delay = min(backoff_cap, backoff_base * 2 ** attempt) * (0.5 + random.random() / 2)
+            logging.warning(f"Captioning call failed ({e}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    parsed_response = json_parser(response.text)
+    if not parsed_response or not isinstance(parsed_response.get('captions'), list):
+        GEMINI_REQUESTS_TOTAL.inc(result="unparseable")
+        raise CaptioningError(f"Unparseable captioning response: {response.text!r}")
+    return parsed_response['captions']
+
+
+def caption_files(client, images, model_name, max_workers=8, requests_per_minute=60, max_retries=4, progress=None):
+    """Captions images concurrently on a bounded thread pool sharing one rate limit.
+    `images` maps a name to either a file path or content ready to send to the client.
+    A failing image never aborts the batch; returns (captions by name, errors by name).
+    `progress(done, total)` is called as each image finishes"""
+    bucket = TokenBucket(requests_per_minute)
+    captions, errors = {}, {}
+
+    def _work(content):
+        if isinstance(content, Path):
+            with Image.open(content) as img:
+                img.load()
+                return caption_image(client, img, model_name, bucket, max_retries)
+        return caption_image(client, content, model_name, bucket, max_retries)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_work, content): name for name, content in images.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                captions[name] = future.result()
+                logging.debug(f"Captioned {name}")
+            except Exception as e:
+                logging.error(f"Captioning failed for {name}: {e}")
+                errors[name] = str(e)
+            if progress is not None:
+                progress(len(captions) + len(errors), len(futures))
+    return captions, errors
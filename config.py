@@ -1,16 +1,129 @@
-from google import genai
 import os
+import threading
 from dotenv import load_dotenv
-from pinecone import Pinecone
 
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-client = genai.Client()
-
 PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
-pc = Pinecone(api_key=PINECONE_API_KEY)
+
+# Remote clients are built on first use so importing config (and every module that does)
+# stays cheap and works without credentials; health and auth routes never touch them
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_genai_client():
+    with _clients_lock:
+        if "genai" not in _clients:
+            from google import genai
+            _clients["genai"] = genai.Client()
+        return _clients["genai"]
+
+def get_pinecone_client():
+    with _clients_lock:
+        if "pinecone" not in _clients:
+            from pinecone import Pinecone
+            _clients["pinecone"] = Pinecone(api_key=PINECONE_API_KEY)
+        return _clients["pinecone"]
+
 INDEX_NAME = "deep-image-retriever"
 INDEX_HOST = "https://deep-image-retriever-wvoooip.svc.aped-4627-b74a.pinecone.io"
+EMBEDDING_DIM = 512
+
+# "pinecone" or "local" (embedded NumPy index persisted under LOCAL_INDEX_DIR)
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pinecone")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "index")
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 100))
+UPSERT_WORKERS = int(os.getenv("UPSERT_WORKERS", 4))
 
 SECRET_KEY = os.getenv('SECRET_KEY')
+
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+CLIP_BATCH_SIZE = int(os.getenv("CLIP_BATCH_SIZE", 32))
+# "fp32", or "int8" for dynamic int8 quantization of the text and vision transformers
+# (check what it costs with quantization_check.py before switching a deployment)
+CLIP_INFERENCE_MODE = os.getenv("CLIP_INFERENCE_MODE", "fp32")
+# torch thread pools per worker process; 0 keeps torch's defaults
+TORCH_INTRA_OP_THREADS = int(os.getenv("TORCH_INTRA_OP_THREADS", 0))
+TORCH_INTER_OP_THREADS = int(os.getenv("TORCH_INTER_OP_THREADS", 0))
+
+GEMINI_CAPTION_MODEL = "gemini-2.5-flash"
+CAPTION_WORKERS = int(os.getenv("CAPTION_WORKERS", 8))
+CAPTION_REQUESTS_PER_MINUTE = int(os.getenv("CAPTION_REQUESTS_PER_MINUTE", 60))
+CAPTION_MAX_RETRIES = int(os.getenv("CAPTION_MAX_RETRIES", 4))
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 1))
+INGEST_QUEUE_DEPTH = int(os.getenv("INGEST_QUEUE_DEPTH", 8))
+
+FEATURE_CACHE_ENABLED = os.getenv("FEATURE_CACHE_ENABLED", "1") == "1"
+FEATURE_CACHE_DIR = os.getenv("FEATURE_CACHE_DIR", "cache")
+FEATURE_CACHE_MAX_ENTRIES = int(os.getenv("FEATURE_CACHE_MAX_ENTRIES", 100000))
+
+CAPTION_IMAGE_MAX_SIDE = int(os.getenv("CAPTION_IMAGE_MAX_SIDE", 768))
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", 4))
+
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", 32))
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", 5))
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 10000))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", 24 * 3600))
+QUERY_RESULT_CACHE_SIZE = int(os.getenv("QUERY_RESULT_CACHE_SIZE", 2000))
+QUERY_RESULT_CACHE_TTL = float(os.getenv("QUERY_RESULT_CACHE_TTL", 300))
+
+SEARCH_MAX_K = int(os.getenv("SEARCH_MAX_K", 100))
+# first page fetches k * SEARCH_OVERFETCH results so the next pages come from cache
+SEARCH_OVERFETCH = int(os.getenv("SEARCH_OVERFETCH", 4))
+SEARCH_MAX_WINDOW = int(os.getenv("SEARCH_MAX_WINDOW", 1000))
+
+# Fuse BM25 over Gemini captions with the CLIP vector ranking (reciprocal-rank fusion)
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+KEYWORD_INDEX_PATH = os.getenv("KEYWORD_INDEX_PATH", os.path.join(LOCAL_INDEX_DIR, "captions_bm25.jsonl"))
+
+# Re-rank the top RERANK_CANDIDATES with the separate image/caption embeddings kept in RERANK_STORE_DIR
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "1") == "1"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 200))
+RERANK_IMAGE_WEIGHT = float(os.getenv("RERANK_IMAGE_WEIGHT", 0.5))
+RERANK_STORE_DIR = os.getenv("RERANK_STORE_DIR", os.path.join(LOCAL_INDEX_DIR, "rerank"))
+
+# Per-image ingestion state, used to resume interrupted ingests
+MANIFEST_PATH = os.getenv("MANIFEST_PATH", os.path.join(LOCAL_INDEX_DIR, "manifest.sqlite3"))
+RESUME_ON_STARTUP = os.getenv("RESUME_ON_STARTUP", "1") == "1"
+# Each process renews a lease on its ingests; rows whose owner's lease ran out are resumable
+MANIFEST_LEASE_SECONDS = float(os.getenv("MANIFEST_LEASE_SECONDS", 30))
+
+# Points at the index generation (namespace prefix) queries and ingests use; switched by reindex.py
+INDEX_GENERATION_PATH = os.getenv("INDEX_GENERATION_PATH", os.path.join(LOCAL_INDEX_DIR, "active_generation"))
+REINDEX_WORKERS = int(os.getenv("REINDEX_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+REINDEX_BATCH_SIZE = int(os.getenv("REINDEX_BATCH_SIZE", 32))
+# Upper bound on the catch-up passes over images ingested while a reindex runs
+REINDEX_CATCH_UP_PASSES = int(os.getenv("REINDEX_CATCH_UP_PASSES", 10))
+
+# Google Photos library import (PHOTOS_API_BASE can point at a local mock of the API)
+PHOTOS_API_BASE = os.getenv("PHOTOS_API_BASE", "https://photoslibrary.googleapis.com/v1")
+PHOTOS_PAGE_SIZE = int(os.getenv("PHOTOS_PAGE_SIZE", 100))
+PHOTOS_DOWNLOAD_CONCURRENCY = int(os.getenv("PHOTOS_DOWNLOAD_CONCURRENCY", 8))
+PHOTOS_DOWNLOAD_RETRIES = int(os.getenv("PHOTOS_DOWNLOAD_RETRIES", 3))
+PHOTOS_IMPORT_STATE_DIR = os.getenv("PHOTOS_IMPORT_STATE_DIR", os.path.join(LOCAL_INDEX_DIR, "photos_import"))
+
+# Requests slower than PROFILE_SLOW_REQUEST_MS get a sampled stack profile written to PROFILE_DIR (0 disables)
+PROFILE_SLOW_REQUEST_MS = float(os.getenv("PROFILE_SLOW_REQUEST_MS", 0))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Near-duplicate (burst shot) collapsing: a perceptual-hash match within NEAR_DUP_HASH_DISTANCE bits
+# confirmed by CLIP image similarity >= NEAR_DUP_MIN_SIMILARITY joins the earlier image's cluster
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "1") == "1"
+NEAR_DUP_HASH_DISTANCE = int(os.getenv("NEAR_DUP_HASH_DISTANCE", 10))
+NEAR_DUP_MIN_SIMILARITY = float(os.getenv("NEAR_DUP_MIN_SIMILARITY", 0.95))
+NEAR_DUP_RECENT = int(os.getenv("NEAR_DUP_RECENT", 5000))
+CLUSTER_INDEX_PATH = os.getenv("CLUSTER_INDEX_PATH", os.path.join(LOCAL_INDEX_DIR, "clusters.sqlite3"))
+
+# "More like this": most image ids one /similar request may ask neighbours for
+SIMILAR_MAX_IDS = int(os.getenv("SIMILAR_MAX_IDS", 100))
+
+# Thumbnails (longest side in px, at most CAPTION_IMAGE_MAX_SIDE) written at ingest in THUMBNAIL_FORMATS
+# and served by /photo/{image_id}; other sizes/formats in the lists below are generated on first request
+THUMBNAIL_SIZES = tuple(int(size) for size in os.getenv("THUMBNAIL_SIZES", "256,512").split(","))
+THUMBNAIL_FORMATS = tuple(os.getenv("THUMBNAIL_FORMATS", "webp").split(","))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+THUMBNAIL_DIR = os.getenv("THUMBNAIL_DIR", os.path.join("photos", "thumbs"))
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+def content_hash(path):
+    """sha256 of a stored image; content-addressed files (see save_locally) are named by it already"""
+    path = Path(path)
+    if len(path.stem) == 64 and all(c in "0123456789abcdef" for c in path.stem):
+        return path.stem
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def captions_hash(captions):
+    return hashlib.sha1(json.dumps(captions, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class FeatureCache:
+    """Persistent cache of Gemini captions and CLIP embeddings keyed by image content hash.
+
+    Entries are versioned (model name + prompt/fusion version) so changing either
+    never serves stale results. Embeddings are stored as float32 blobs. When the
+    number of entries of a kind exceeds `max_entries`, the least recently used
+    ones are evicted."""
+
+    def __init__(self, cache_dir, max_entries=100000):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._puts = 0
+        self.stats = {"caption_hits": 0, "caption_misses": 0,
+                      "embedding_hits": 0, "embedding_misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.cache_dir / "features.sqlite3", check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS captions (
+                image_hash TEXT, version TEXT, captions TEXT, last_access REAL,
+                PRIMARY KEY (image_hash, version));
+            CREATE TABLE IF NOT EXISTS embeddings (
+                image_hash TEXT, version TEXT, captions_hash TEXT, vector BLOB, last_access REAL,
+                PRIMARY KEY (image_hash, version, captions_hash));
+            CREATE INDEX IF NOT EXISTS captions_lru ON captions (last_access);
+            CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_access);
+        """)
+
+    def get_captions(self, image_hash, version):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT captions FROM captions WHERE image_hash = ? AND version = ?",
+                (image_hash, version)).fetchone()
+            if row is None:
+                self.stats["caption_misses"] += 1
+                return None
+            self.stats["caption_hits"] += 1
+            self._conn.execute("UPDATE captions SET last_access = ? WHERE image_hash = ? AND version = ?",
+                               (time.time(), image_hash, version))
+            self._conn.commit()
+            return json.loads(row[0])
+
+    def put_captions(self, image_hash, version, captions):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?)",
+                               (image_hash, version, json.dumps(captions), time.time()))
+            self._maybe_evict("captions")
+            self._conn.commit()
+
+    def get_embedding(self, image_hash, version, captions):
+        with self._lock:
+            key = (image_hash, version, captions_hash(captions))
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE image_hash = ? AND version = ? AND captions_hash = ?",
+                key).fetchone()
+            if row is None:
+                self.stats["embedding_misses"] += 1
+                return None
+            self.stats["embedding_hits"] += 1
+            self._conn.execute(
+                "UPDATE embeddings SET last_access = ? WHERE image_hash = ? AND version = ? AND captions_hash = ?",
+                (time.time(), *key))
+            self._conn.commit()
+            return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def put_embedding(self, image_hash, version, captions, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+                               (image_hash, version, captions_hash(captions), vector.tobytes(), time.time()))
+            self._maybe_evict("embeddings")
+            self._conn.commit()
+
+    def _maybe_evict(self, table):
+        # counting rows is a table scan, so the bound is only enforced every 64 writes
+        self._puts += 1
+        if self._puts % 64 == 0:
+            self._evict(table)
+
+    def _evict(self, table):
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY last_access LIMIT ?)",
+                (excess,))
+            self.stats["evictions"] += excess
+            logging.debug(f"Evicted {excess} entries from feature cache {table}")
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            for kind in ("caption", "embedding"):
+                lookups = stats[f"{kind}_hits"] + stats[f"{kind}_misses"]
+                stats[f"{kind}_hit_rate"] = round(stats[f"{kind}_hits"] / lookups, 3) if lookups else None
+            stats["caption_entries"] = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+            stats["embedding_entries"] = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return stats
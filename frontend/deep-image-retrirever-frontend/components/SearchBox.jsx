@@ -22,11 +22,15 @@ function SearchBox() {
       const data = await res.json();
 
       // Normalize paths coming from backend (replace '\' with '/')
-      const images = (data["retreived images"] || []).map((path) => {
+      // and show the 256px thumbnail instead of the full-size photo
+      const thumbnails = data.thumbnails || [];
+      const images = (data["retrieved_images"] || []).map((path, i) => {
         const normalizedPath = path.replace(/\\/g, "/");
+        const name = normalizedPath.split("/").pop();
+        const thumbnail = (thumbnails[i] || {})["256"] || `/photo/${name}?size=256`;
         return {
-          url: `http://localhost:8000/${normalizedPath}`,
-          name: normalizedPath.split("/").pop(),
+          url: `http://localhost:8000${thumbnail}`,
+          name,
         };
       });
 
@@ -145,6 +149,7 @@ function SearchBox() {
               <img
                 src={img.url}
                 alt={img.name}
+                loading="lazy"
                 style={{
                   width: "100%",
                   height: "200px",
@@ -1,50 +1,177 @@
 import uuid
+import hashlib
 import os
 import shutil
+import threading
+import time
+from collections import defaultdict
 from pathlib import Path
-from google import genai
-from config import client, pc, INDEX_NAME, INDEX_HOST
+from config import get_genai_client, get_pinecone_client, INDEX_NAME, INDEX_HOST
+from config import VECTOR_STORE_BACKEND, LOCAL_INDEX_DIR, EMBEDDING_DIM, UPSERT_BATCH_SIZE, UPSERT_WORKERS
+from config import GEMINI_CAPTION_MODEL, CAPTION_WORKERS, CAPTION_REQUESTS_PER_MINUTE, CAPTION_MAX_RETRIES
+from config import CLIP_MODEL_NAME, CLIP_BATCH_SIZE, FEATURE_CACHE_ENABLED, FEATURE_CACHE_DIR, FEATURE_CACHE_MAX_ENTRIES
+from config import CAPTION_IMAGE_MAX_SIDE, PREPROCESS_WORKERS, CLIP_INFERENCE_MODE
+from captioning import caption_files
+from preprocessing import preprocess_image, preprocess_files, decode_image, image_metadata
+from feature_cache import FeatureCache, content_hash
 from prompts import CAPTIONING_PROMPT_BETA
-from parsers import json_parser
 import logging
 import pathlib
-from PIL import Image
-from transformers import CLIPProcessor, CLIPModel
-import torch
-from pinecone.grpc import PineconeGRPC as Pinecone
-from pinecone import ServerlessSpec
+from model_registry import get_clip_model
+from vector_store import LocalVectorStore, PineconeVectorStore
+from keyword_index import BM25Index
+from config import KEYWORD_INDEX_PATH, RERANK_ENABLED, RERANK_STORE_DIR
+from rerank_store import RerankStore
+from ingest_manifest import IngestManifest
+from config import MANIFEST_PATH, MANIFEST_LEASE_SECONDS, INDEX_GENERATION_PATH
+from config import NEAR_DUP_ENABLED, NEAR_DUP_HASH_DISTANCE, NEAR_DUP_MIN_SIMILARITY, NEAR_DUP_RECENT, CLUSTER_INDEX_PATH
+from near_duplicates import ClusterIndex, assign_clusters
+from config import THUMBNAIL_SIZES, THUMBNAIL_FORMATS, THUMBNAIL_QUALITY, THUMBNAIL_DIR
+from thumbnails import write_thumbnails, thumbnail_path
+from query_cache import invalidate_results
 
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# guards the lazily created process-wide clients and stores below, so concurrent first callers share one
+_singletons_lock = threading.RLock()
+
 def save_locally(files, save_dir):
-    """Saves files in local directory"""
+    """Saves files in local directory under their sha256 content hash.
+    Files are streamed to disk in chunks while hashing; exact duplicates of content
+    already ingested or being ingested are discarded (see commit_part).
+    Returns (stored file names, (original name, content name) of each skipped duplicate)"""
+    stored, duplicates = [], []
     for file in files:
-        ext = os.path.splitext(file.filename)[1]
-        unique_name = f"{uuid.uuid4()}{ext}"
-        file_path = save_dir / unique_name
+        ext = os.path.splitext(file.filename)[1].lower()
+        part_path = save_dir / f".{uuid.uuid4()}.part"
+        digest = hashlib.sha256()
         
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        with open(part_path, "wb") as buffer:
+            while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                buffer.write(chunk)
+        
+        content_name, is_new = commit_part(part_path, digest.hexdigest(), ext, save_dir)
+        if not is_new:
+            duplicates.append((file.filename, content_name))
+            continue
+        stored.append(content_name)
+    return stored, duplicates
+
+def commit_part(part_path, hexdigest, ext, save_dir):
+    """Renames a fully written .part file to its content hash name in save_dir.
+    Content is matched on the hash alone, so bytes seen before under another extension keep their
+    first name. Returns (content name, False) and removes the part if the manifest has the content
+    upserted or clustered, a live job owns it, or it sits in a job dir next to save_dir (the temp
+    dirs of in-flight jobs); else (content name, True). Images that failed are stored again"""
+    manifest = get_manifest()
+    states = manifest.find_content(hexdigest)
+    done = [name for name, state in states.items() if state in ("upserted", "clustered")]
+    active = manifest.in_progress(states)
+    content_name = next(iter(done or active or states), f"{hexdigest}{ext}")
+    if done or active or any(save_dir.parent.glob(f"*/{content_name}")):
+        part_path.unlink()
+        return content_name, False
+    os.replace(part_path, save_dir / content_name)
+    return content_name, True
 
 def save_s3(files):
     """Saves files in cloud AWS S3 bucket"""
     pass
 
+# Bump when the prompt/model or the fusion in call_clip_model_batch changes so cached results are not reused
+CAPTION_CACHE_VERSION = f"{GEMINI_CAPTION_MODEL}:{hashlib.sha1(CAPTIONING_PROMPT_BETA.encode()).hexdigest()[:8]}"
+EMBEDDING_CACHE_VERSION = f"{CLIP_MODEL_NAME}:mean-text-fusion-v2:{CAPTION_IMAGE_MAX_SIDE}"
+if CLIP_INFERENCE_MODE != "fp32":
+    EMBEDDING_CACHE_VERSION += f":{CLIP_INFERENCE_MODE}"
+
+_feature_cache = None
+
+def get_feature_cache():
+    """Returns the process-wide caption/embedding cache, or None when FEATURE_CACHE_ENABLED is off"""
+    global _feature_cache
+    with _singletons_lock:
+        if _feature_cache is None and FEATURE_CACHE_ENABLED:
+            _feature_cache = FeatureCache(FEATURE_CACHE_DIR, max_entries=FEATURE_CACHE_MAX_ENTRIES)
+    return _feature_cache
+
+# Gemini client, created on first use (assign a stand-in here to caption offline)
+client = None
+
 def load_captioning_model():
+    global client
+    with _singletons_lock:
+        if client is None:
+            client = get_genai_client()
     return client
 
-def perform_captioning(model, img_dir):
-    """Performs captioning on images stored in recent dir"""
+def _write_ingest_thumbnails(name, img):
+    try:
+        write_thumbnails(img, name, Path(THUMBNAIL_DIR), THUMBNAIL_SIZES, THUMBNAIL_FORMATS, THUMBNAIL_QUALITY)
+    except Exception as e:
+        # get_thumbnail regenerates it from the original when first requested
+        logging.warning(f"Thumbnails for {name} failed: {e}")
+
+def preprocess_images(img_dir, errors=None, progress=None):
+    """Decodes every image in img_dir once into a caption-sized JPEG, a perceptual hash and its thumbnails.
+    CLIP pixel tensors are not kept: a whole upload's worth would sit in memory through captioning,
+    so they are rebuilt from the JPEGs a batch at a time (clip_pixels)"""
+    _, processor = _load_clip_model()
+    files = [file for file in img_dir.iterdir() if file.is_file()]
+    preprocessed, failed = preprocess_files(files, processor,
+                                            max_side = CAPTION_IMAGE_MAX_SIDE,
+                                            max_workers = PREPROCESS_WORKERS,
+                                            progress = progress,
+                                            on_decoded = _write_ingest_thumbnails,
+                                            with_pixels = False)
+    if errors is not None:
+        errors.update(failed)
+    return preprocessed
+
+def perform_captioning(model, img_dir, errors=None, progress=None, preprocessed=None):
+    """Performs captioning on images stored in recent dir.
+    Cached captions are reused; the rest are captioned concurrently under a requests-per-minute
+    limit. Images that fail are left out of the result and, if `errors` is given, recorded there by name.
+    When `preprocessed` is given only those images are captioned, using their downscaled JPEG copies"""
     img_captioning_pairs = {}
-    if type(img_dir) == pathlib.WindowsPath: 
-        for file in img_dir.iterdir():
-            logging.debug('Running')
-            img = Image.open(file)
-            reponse = client.models.generate_content(
-                model = "gemini-2.5-flash",
-                contents = [img, CAPTIONING_PROMPT_BETA]
-            )
-            parsed_response = json_parser(reponse.text)
-            img_captioning_pairs[file.name] = parsed_response['captions']
+    if isinstance(img_dir, pathlib.Path):
+        files = [file for file in img_dir.iterdir() if file.is_file()]
+        if preprocessed is not None:
+            files = [file for file in files if file.name in preprocessed]
+        cache = get_feature_cache()
+        hashes = {}
+        if cache is not None:
+            for file in files:
+                hashes[file.name] = content_hash(file)
+                cached = cache.get_captions(hashes[file.name], CAPTION_CACHE_VERSION)
+                if cached is not None:
+                    img_captioning_pairs[file.name] = cached
+        uncached = {}
+        for file in files:
+            if file.name in img_captioning_pairs:
+                continue
+            if preprocessed is not None:
+                from google.genai import types
+                uncached[file.name] = types.Part.from_bytes(data=preprocessed[file.name].caption_jpeg, mime_type="image/jpeg")
+            else:
+                uncached[file.name] = file
+        logging.debug(f'Captioning {len(uncached)} images, {len(img_captioning_pairs)} served from cache')
+        
+        captions, failed = caption_files(
+            model, uncached,
+            model_name = GEMINI_CAPTION_MODEL,
+            max_workers = CAPTION_WORKERS,
+            requests_per_minute = CAPTION_REQUESTS_PER_MINUTE,
+            max_retries = CAPTION_MAX_RETRIES,
+            progress = progress,
+        )
+        if cache is not None:
+            for name, img_captions in captions.items():
+                cache.put_captions(hashes[name], CAPTION_CACHE_VERSION, img_captions)
+        img_captioning_pairs.update(captions)
+        if errors is not None:
+            errors.update(failed)
     
     else:
         # cloud recent dir
@@ -54,74 +181,353 @@ def perform_captioning(model, img_dir):
 
 def move_files(source, dest):
     """Empties recent dir and moves the contents to dest"""
-    if type(source) == pathlib.WindowsPath:
+    if isinstance(source, pathlib.Path):
+        dest.mkdir(parents=True, exist_ok=True)
         for item in source.iterdir():
             target_path = dest / item.name
             shutil.move(str(item), str(target_path))
 
 def _load_clip_model():
-    """Loads clip model and preprocessor"""
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-    return model, processor
+    """Returns the shared clip model and preprocessor, loaded once per process"""
+    return get_clip_model()
+
+_generation = (None, "")
+
+def active_generation():
+    """Index generation that queries and ingests use ("" for the original one).
+    reindex.py switches it by atomically replacing INDEX_GENERATION_PATH; the file's
+    mtime is checked on every call so all workers follow a switch"""
+    global _generation
+    try:
+        mtime = os.stat(INDEX_GENERATION_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return ""
+    if _generation[0] != mtime:
+        with open(INDEX_GENERATION_PATH) as f:
+            _generation = (mtime, f.read().strip())
+    return _generation[1]
+
+def set_active_generation(generation):
+    os.makedirs(os.path.dirname(INDEX_GENERATION_PATH) or ".", exist_ok=True)
+    tmp_path = f"{INDEX_GENERATION_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(generation)
+    os.replace(tmp_path, INDEX_GENERATION_PATH)
+
+def user_namespace(user_id=None):
+    """Logical namespace holding a user's photos; anonymous uploads share "__default__".
+    Ids are hashed so they are safe as directory names in the local store"""
+    if user_id is None:
+        return "__default__"
+    return f"user-{hashlib.sha1(str(user_id).encode()).hexdigest()[:16]}"
+
+def index_namespace(namespace="__default__", generation=None):
+    """Vector store namespace for a logical namespace within an index generation"""
+    generation = active_generation() if generation is None else generation
+    return f"{generation}-{namespace}" if generation else namespace
+
+_rerank_stores = {}
+
+def get_rerank_store(generation=None):
+    """Returns the store of separate image/caption embeddings for an index generation
+    (the active one by default), or None when RERANK_ENABLED is off"""
+    if not RERANK_ENABLED:
+        return None
+    generation = active_generation() if generation is None else generation
+    with _singletons_lock:
+        if generation not in _rerank_stores:
+            root_dir = f"{RERANK_STORE_DIR}-{generation}" if generation else RERANK_STORE_DIR
+            _rerank_stores[generation] = RerankStore(root_dir, dimension=EMBEDDING_DIM)
+        return _rerank_stores[generation]
+
+def embed_images(img_paths, img_captions_list, pixel_values=None):
+    """call_clip_model_batch that reuses cached embeddings and only runs clip on the misses.
+    The image and per-caption embeddings of every computed image are kept in the rerank store"""
+    import torch
+    cache = get_feature_cache()
+    rerank_store = get_rerank_store()
+    
+    hashes = [content_hash(img_path) for img_path in img_paths] if cache is not None else None
+    embeddings = [None] * len(img_paths)
+    if cache is not None:
+        for i, (image_hash, img_captions) in enumerate(zip(hashes, img_captions_list)):
+            if rerank_store is not None and str(img_paths[i]) not in rerank_store:
+                continue
+            cached = cache.get_embedding(image_hash, EMBEDDING_CACHE_VERSION, img_captions)
+            if cached is not None:
+                embeddings[i] = torch.from_numpy(cached)
+    
+    misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if misses:
+        computed, image_embeds, text_embeds, counts = call_clip_model_batch(
+            [img_paths[i] for i in misses], [img_captions_list[i] for i in misses],
+            [pixel_values[i] for i in misses] if pixel_values is not None else None,
+            return_components=True)
+        if rerank_store is not None:
+            rerank_store.add([str(img_paths[i]) for i in misses], image_embeds.numpy(), text_embeds.numpy(), counts.tolist())
+        for i, embedding in zip(misses, computed):
+            embeddings[i] = embedding
+            if cache is not None:
+                cache.put_embedding(hashes[i], EMBEDDING_CACHE_VERSION, img_captions_list[i], embedding.numpy())
+    return embeddings
 
 def call_clip_model(img_path, img_captions):
-    model, processor = _load_clip_model()
-    img = Image.open(img_path)
-    inputs = processor(text = img_captions,
-                       images = img,
+    return call_clip_model_batch([img_path], [img_captions])[0]
+
+def call_clip_model_batch(img_paths, img_captions_list, pixel_values=None, return_components=False, clip_model=None):
+    """Runs one clip forward pass over N images and all of their captions.
+    Captions are flattened into a single padded text batch and the per image
+    mean text embedding is recovered with a segment-mean, so each result is the
+    same (image + mean_text) / 2 fusion call_clip_model produces.
+    Images are decoded through preprocess_image unless their pixel_values are passed in.
+    With return_components, also returns the normalized image embeddings, the flat caption
+    embeddings and the per image caption counts. clip_model is a (model, processor) pair to
+    run instead of the shared one, e.g. to compare inference modes."""
+    import torch
+    model, processor = clip_model or _load_clip_model()
+    if pixel_values is None:
+        pixel_values = [preprocess_image(Path(img_path), processor, CAPTION_IMAGE_MAX_SIDE).pixel_values
+                        for img_path in img_paths]
+    flat_captions = [caption for captions in img_captions_list for caption in captions]
+    counts = torch.tensor([len(captions) for captions in img_captions_list])
+    inputs = processor(text = flat_captions or [""],
                        return_tensors = "pt",
                        padding = True)
+    inputs["pixel_values"] = torch.stack(pixel_values)
     with torch.no_grad():
         outputs = model(**inputs)
         image_embeds = outputs.image_embeds
         text_embeds = outputs.text_embeds
         image_embeds = image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
         text_embeds = text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
-        mean_text_embed = text_embeds.mean(dim=0, keepdim=True)
+        # segment-mean: row i of text_embeds belongs to image segment_ids[i]
+        segment_ids = torch.repeat_interleave(torch.arange(len(img_paths)), counts)
+        text_sums = torch.zeros_like(image_embeds).index_add_(0, segment_ids, text_embeds[:len(segment_ids)])
+        mean_text_embed = text_sums / counts.clamp(min=1).unsqueeze(1).to(text_sums.dtype)
+        # images without captions fall back to the image embedding alone
+        mean_text_embed[counts == 0] = image_embeds[counts == 0]
         combined_embed = (image_embeds + mean_text_embed) / 2
         combined_embed = combined_embed / combined_embed.norm(p=2, dim=-1, keepdim=True)
-    # sim = torch.cosine_similarity(image_embeds, combined_embed)
-    # print(sim)
-    return combined_embed.squeeze(0)
+    if return_components:
+        return list(combined_embed.unbind(0)), image_embeds, text_embeds[:len(segment_ids)], counts
+    return list(combined_embed.unbind(0))
    
-def get_topk_records(q_emb):
-    index = pc.Index(host=INDEX_HOST)
-    matches = index.query(
-                    namespace="__default__",
-                    vector=q_emb, 
-                    top_k=5,
+_vector_store = None
+
+def get_vector_store():
+    """Returns the process-wide vector store selected by VECTOR_STORE_BACKEND ("pinecone" or "local")"""
+    global _vector_store
+    with _singletons_lock:
+        if _vector_store is None:
+            if VECTOR_STORE_BACKEND == "local":
+                _vector_store = LocalVectorStore(LOCAL_INDEX_DIR, dimension=EMBEDDING_DIM)
+            else:
+                _vector_store = PineconeVectorStore(get_pinecone_client(), INDEX_NAME, INDEX_HOST, dimension=EMBEDDING_DIM,
+                                                    upsert_batch_size=UPSERT_BATCH_SIZE,
+                                                    upsert_workers=UPSERT_WORKERS)
+            logging.info(f"Using {type(_vector_store).__name__}")
+    return _vector_store
+
+_manifest = None
+
+def get_manifest():
+    """Returns the process-wide per-image ingestion state manifest"""
+    global _manifest
+    with _singletons_lock:
+        if _manifest is None:
+            _manifest = IngestManifest(MANIFEST_PATH, MANIFEST_LEASE_SECONDS)
+    return _manifest
+
+_keyword_indexes = {}
+
+def get_keyword_index(user_id=None):
+    """Returns the process-wide BM25 index over a user's image captions"""
+    namespace = user_namespace(user_id)
+    with _singletons_lock:
+        if namespace not in _keyword_indexes:
+            path = Path(KEYWORD_INDEX_PATH)
+            if namespace != "__default__":
+                path = path.with_name(f"{path.stem}-{namespace}{path.suffix}")
+            _keyword_indexes[namespace] = BM25Index(path)
+        return _keyword_indexes[namespace]
+
+_cluster_index = None
+
+def get_cluster_index():
+    """Returns the process-wide near-duplicate cluster index, or None when NEAR_DUP_ENABLED is off"""
+    global _cluster_index
+    with _singletons_lock:
+        if _cluster_index is None and NEAR_DUP_ENABLED:
+            _cluster_index = ClusterIndex(CLUSTER_INDEX_PATH, recent=NEAR_DUP_RECENT)
+    return _cluster_index
+
+def get_thumbnail(image_path, size, fmt):
+    """Path of a thumbnail of an original image, generated from the original if it was not written
+    at ingest (photos ingested before thumbnails existed, or a format not in THUMBNAIL_FORMATS)"""
+    path = thumbnail_path(THUMBNAIL_DIR, image_path.name, size, fmt)
+    if not path.exists():
+        write_thumbnails(decode_image(image_path, size), image_path.name, Path(THUMBNAIL_DIR), [size], [fmt],
+                         THUMBNAIL_QUALITY)
+    return path
+
+def clip_pixels(preprocessed_images):
+    """CLIP pixel tensors for PreprocessedImages, rebuilt from their caption JPEGs where not kept"""
+    _, processor = _load_clip_model()
+    return [image.clip_pixels(processor) for image in preprocessed_images]
+
+def embed_image_pixels(pixel_values):
+    """L2-normalized CLIP image embeddings from the vision tower alone, one row per pixel tensor"""
+    import torch
+    model, _ = _load_clip_model()
+    with torch.no_grad():
+        image_embeds = model.get_image_features(pixel_values=torch.stack(pixel_values))
+    return (image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)).numpy()
+
+def collapse_near_duplicates(preprocessed, persist_dir, user_id=None):
+    """Assigns user_id's preprocessed images (with perceptual hashes) to near-duplicate clusters.
+    Returns {image name: representative name} for the images that joined an existing cluster;
+    those are kept on disk but not captioned or indexed"""
+    index = get_cluster_index()
+    if index is None or not preprocessed:
+        return {}
+    _, processor = _load_clip_model()
+
+    def _embed(image_ids):
+        pixels = {}
+        for image_id in image_ids:
+            if image_id in preprocessed:
+                pixels[image_id] = preprocessed[image_id].clip_pixels(processor)
+            elif (persist_dir / image_id).exists():
+                pixels[image_id] = preprocess_image(persist_dir / image_id, processor, CAPTION_IMAGE_MAX_SIDE).pixel_values
+        embeddings = {}
+        ids = list(pixels)
+        for start in range(0, len(ids), CLIP_BATCH_SIZE):
+            batch = ids[start:start + CLIP_BATCH_SIZE]
+            embeddings.update(zip(batch, embed_image_pixels([pixels[image_id] for image_id in batch])))
+        return embeddings
+
+    return assign_clusters({name: image.phash for name, image in preprocessed.items()}, index, _embed,
+                           max_distance=NEAR_DUP_HASH_DISTANCE, min_similarity=NEAR_DUP_MIN_SIMILARITY,
+                           user_id=user_id)
+
+def collapse_clusters(image_paths):
+    """Keeps the first (best ranked) image of each near-duplicate cluster"""
+    index = get_cluster_index()
+    if index is None or len(image_paths) < 2:
+        return image_paths
+    clusters = index.clusters(Path(image_path).name for image_path in image_paths)
+    seen, collapsed = set(), []
+    for image_path in image_paths:
+        cluster_id = clusters.get(Path(image_path).name, (image_path,))[0]
+        if cluster_id not in seen:
+            seen.add(cluster_id)
+            collapsed.append(image_path)
+    return collapsed
+
+def get_topk_records(q_emb, top_k=5, user_id=None, filter=None):
+    """Nearest records in user_id's namespace; `filter` (metadata filter) is applied by the store before ranking"""
+    matches = get_vector_store().query(
+                    vector=q_emb,
+                    top_k=top_k,
+                    namespace=index_namespace(user_namespace(user_id)),
                     include_metadata=True,
-                    include_values=False
+                    filter=filter
                 )
     return matches
 
-         
-def push_to_pinecone(records):
-    index_list = pc.list_indexes()
-    existing_names = [idx['name'] for idx in index_list]
-
-    if INDEX_NAME not in existing_names:
-        pc.create_index(
-            name=INDEX_NAME,
-            dimension=512,
-            metric="cosine",
-            spec=ServerlessSpec(cloud="aws", region="us-east-1"),
-            deletion_protection="disabled"
-        )
-        print("INDEX CREATED")
-    else:
-        print("Index already exists, skipping creation.")
-    
-    index = pc.Index(INDEX_NAME)
-    vectors = []
+def get_topk_records_many(q_embs, top_k=5, user_id=None, filter=None):
+    """get_topk_records for several query vectors in one store call"""
+    return get_vector_store().query_many(q_embs, top_k=top_k, namespace=index_namespace(user_namespace(user_id)),
+                                         include_metadata=True, filter=filter)
+
+def fetch_stored_vectors(image_ids, user_id=None):
+    """Vectors in user_id's namespace by image id, {id: [...]}; ids that are not indexed there are omitted"""
+    return {image_id: record["values"]
+            for image_id, record in get_vector_store().fetch(image_ids, namespace=index_namespace(user_namespace(user_id))).items()}
+
+def embed_query_image(file):
+    """CLIP image embedding of an uploaded file (path or file object); runs only the vision tower"""
+    _, processor = _load_clip_model()
+    img = decode_image(file, CAPTION_IMAGE_MAX_SIDE)
+    pixel_values = processor.image_processor(images=img, return_tensors="pt")["pixel_values"][0]
+    return embed_image_pixels([pixel_values])[0]
+
+def _upsert_for_user(vectors, user_id, generation=None):
+    """Upserts vectors into user_id's namespace and adds the successful ones to their keyword index"""
+    for v in vectors:
+        v["metadata"].pop("user_id", None)
+        if user_id is not None:
+            v["metadata"]["user_id"] = user_id
+    result = get_vector_store().upsert(vectors, namespace=index_namespace(user_namespace(user_id), generation))
+    failed_ids = set(result["failed_ids"])
+    get_keyword_index(user_id).add((v["id"], v["metadata"]["image_path"], v["metadata"]["captions"], v["metadata"])
+                                   for v in vectors if v["id"] not in failed_ids)
+    return result
+
+def push_to_pinecone(records, generation=None):
+    """Upserts {image_path: (captions, embedding)} records into the namespace of every user the manifest
+    records as owning each image, tagged with filterable metadata (owner, upload/capture time, mime type).
+    Returns the store's success/failure counts; an image fails if any of its upserts did"""
+    owners = get_manifest().users(image_path.name for image_path in records)
+    by_user = defaultdict(list)
     for image_path, (captions, embedding) in records.items():
-        vectors.append({
-            "id": str(image_path.name),  
-            "values": embedding.tolist(), 
-            "metadata": {"captions": captions,
-                         "image_path" : str(image_path),}
-        })
-
-    index.upsert(vectors=vectors)
-    print(f"{len(vectors)} vectors inserted into {INDEX_NAME}.")
+        metadata = {"captions": captions,
+                    "image_path" : str(image_path),
+                    **image_metadata(image_path)}
+        for user_id in owners.get(image_path.name, [None]):
+            by_user[user_id].append({
+                "id": str(image_path.name),
+                "values": embedding.tolist(),
+                "metadata": dict(metadata)
+            })
+
+    failed_ids = set()
+    for user_id, vectors in by_user.items():
+        failed_ids.update(_upsert_for_user(vectors, user_id, generation)["failed_ids"])
+    result = {"upserted": len(records) - len(failed_ids), "failed": len(failed_ids), "failed_ids": sorted(failed_ids)}
+    print(f"{result['upserted']} vectors inserted into {INDEX_NAME}, {result['failed']} failed.")
+    return result
+
+def share_indexed(image_ids, user_id, persist_dir=None, stage_dir=None):
+    """Adds user_id as an owner of already stored images (uploads that are exact duplicates).
+    Images indexed for other users are copied into user_id's namespace from their stored vectors,
+    so nothing is re-captioned or re-embedded; images still being ingested reach every owner when
+    their job upserts them. The rest were never indexed (a near-duplicate collapsed into another
+    user's cluster, or an image that failed): they are copied from persist_dir into stage_dir so
+    the caller's job ingests them for every owner. Returns (ids copied, ids staged)"""
+    manifest = get_manifest()
+    owners = manifest.users(image_ids)
+    # images stored before ownership was tracked belong to the anonymous user
+    manifest.add_user([image_id for image_id in image_ids if image_id not in owners], None)
+    manifest.add_user(image_ids, user_id)
+    by_source = defaultdict(list)
+    for image_id in image_ids:
+        users = owners.get(image_id, [None])
+        if user_id not in users:
+            by_source[users[0]].append(image_id)
+
+    copied, unindexed = [], []
+    for source, ids in by_source.items():
+        found = get_vector_store().fetch(ids, namespace=index_namespace(user_namespace(source)))
+        vectors = [{"id": image_id, "values": record["values"],
+                    "metadata": {**record["metadata"], "uploaded_at": int(time.time())}}
+                   for image_id, record in found.items()]
+        if vectors:
+            failed_ids = set(_upsert_for_user(vectors, user_id)["failed_ids"])
+            copied += [v["id"] for v in vectors if v["id"] not in failed_ids]
+        unindexed += [image_id for image_id in ids if image_id not in found]
+    if copied:
+        manifest.touch(copied)
+        invalidate_results()
+        logging.info(f"Shared {len(copied)} already indexed images with {user_namespace(user_id)}")
+
+    staged = []
+    if stage_dir is not None and unindexed:
+        in_progress = manifest.in_progress(unindexed)
+        for image_id in unindexed:
+            if image_id not in in_progress and (persist_dir / image_id).exists():
+                shutil.copyfile(persist_dir / image_id, stage_dir / image_id)
+                staged.append(image_id)
+        if staged:
+            logging.info(f"Queued {len(staged)} never indexed duplicates for ingestion by {user_namespace(user_id)}")
+    return copied, staged
@@ -0,0 +1,207 @@
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# Order of the per-image ingestion states; "failed" sits outside it
+STATES = ("stored", "preprocessed", "captioned", "embedded", "upserted")
+
+# Identifies this process run. Unlike a pid it is never reused, e.g. by a restarted container
+INSTANCE_ID = uuid.uuid4().hex
+
+
+class IngestManifest:
+    """Durable per-image ingestion state, one SQLite row per content-addressed image.
+
+    Every row records the state it reached, the job that owns it and the instance (process run)
+    running that job. Each instance renews a lease in the instances table every few seconds;
+    rows short of "upserted" whose owner's lease has expired were interrupted and can be
+    claimed by a resume job."""
+
+    def __init__(self, path, lease_seconds=30):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                image_id TEXT PRIMARY KEY, state TEXT, job_id TEXT, owner_pid INTEGER,
+                error TEXT, updated_at REAL, owner_instance TEXT);
+            CREATE INDEX IF NOT EXISTS images_state ON images (state);
+            CREATE TABLE IF NOT EXISTS image_users (
+                image_id TEXT, user_id TEXT, PRIMARY KEY (image_id, user_id));
+            CREATE TABLE IF NOT EXISTS instances (
+                instance_id TEXT PRIMARY KEY, pid INTEGER, heartbeat_at REAL);
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(images)")}
+        if "owner_instance" not in columns:
+            # manifests created before instance ownership; another process may be migrating at the same time
+            try:
+                self._conn.execute("ALTER TABLE images ADD COLUMN owner_instance TEXT")
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e):
+                    raise
+        self._heartbeat()
+        threading.Thread(target=self._renew_lease, name="manifest-lease", daemon=True).start()
+        atexit.register(self._release_lease)
+
+    def _heartbeat(self):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO instances (instance_id, pid, heartbeat_at) VALUES (?, ?, ?)",
+                               (INSTANCE_ID, os.getpid(), time.time()))
+            self._conn.commit()
+
+    def _renew_lease(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self._heartbeat()
+            except sqlite3.Error as e:
+                logging.warning(f"Could not renew the manifest lease: {e}")
+
+    def _release_lease(self):
+        """Drops this instance's lease on a clean exit so its unfinished rows can be resumed right away"""
+        try:
+            with self._lock:
+                self._conn.execute("DELETE FROM instances WHERE instance_id = ?", (INSTANCE_ID,))
+                self._conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def _live_instances(self):
+        """{instance_id: lease expiry} of the instances whose lease is current, this one included"""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute("SELECT instance_id, heartbeat_at FROM instances WHERE heartbeat_at >= ?",
+                                      (now - self.lease_seconds,)).fetchall()
+        return {instance_id: heartbeat_at + self.lease_seconds for instance_id, heartbeat_at in rows}
+
+    def mark(self, image_ids, state, job_id=None, error=None, owned=True):
+        """Records state for image_ids; owned=False leaves them unowned so the next resume claims them"""
+        now = time.time()
+        pid, instance = (os.getpid(), INSTANCE_ID) if owned else (None, None)
+        with self._lock:
+            self._conn.executemany("""
+                INSERT INTO images (image_id, state, job_id, owner_pid, owner_instance, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (image_id) DO UPDATE SET
+                    state = excluded.state, job_id = COALESCE(excluded.job_id, images.job_id),
+                    owner_pid = excluded.owner_pid, owner_instance = excluded.owner_instance,
+                    error = excluded.error, updated_at = excluded.updated_at
+            """, [(image_id, state, job_id, pid, instance, error, now) for image_id in image_ids])
+            self._conn.commit()
+
+    def get(self, image_ids):
+        """{image_id: state} for the ids that have a row"""
+        result = {}
+        image_ids = list(image_ids)
+        with self._lock:
+            for i in range(0, len(image_ids), 500):
+                chunk = image_ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT image_id, state FROM images WHERE image_id IN ({','.join('?' * len(chunk))})", chunk)
+                result.update(rows.fetchall())
+        return result
+
+    def find_content(self, hexdigest):
+        """{image_id: state} of the rows for content hash hexdigest, whatever extension it was stored with"""
+        with self._lock:
+            # content names are the hash followed by an ascii extension, so this range covers all of them
+            return dict(self._conn.execute("SELECT image_id, state FROM images WHERE image_id >= ? AND image_id < ?",
+                                           (hexdigest, hexdigest + "\x7f")).fetchall())
+
+    def add_user(self, image_ids, user_id):
+        """Records user_id (None for anonymous uploads) as an owner of image_ids"""
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO image_users (image_id, user_id) VALUES (?, ?)",
+                                   [(image_id, user_id or "") for image_id in image_ids])
+            self._conn.commit()
+
+    def users(self, image_ids):
+        """{image_id: [user_id, ...]} in the order the users added each image. Images recorded
+        before ownership was tracked have no entry and belong to the anonymous (None) user"""
+        result = {}
+        image_ids = list(image_ids)
+        with self._lock:
+            for i in range(0, len(image_ids), 500):
+                chunk = image_ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT image_id, user_id FROM image_users WHERE image_id IN ({','.join('?' * len(chunk))}) ORDER BY rowid",
+                    chunk)
+                for image_id, user_id in rows:
+                    result.setdefault(image_id, []).append(user_id or None)
+        return result
+
+    def unfinished(self, include_failed=False):
+        """Rows short of "upserted" as (image_id, state, job_id, owner_instance, error)"""
+        states = [state for state in STATES if state != "upserted"] + (["failed"] if include_failed else [])
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT image_id, state, job_id, owner_instance, error FROM images WHERE state IN ({','.join('?' * len(states))})",
+                states).fetchall()
+
+    def in_progress(self, image_ids, job_ids=()):
+        """Ids among image_ids short of "upserted" that are owned by an instance whose lease is
+        current or belong to one of job_ids"""
+        image_ids, job_ids = list(image_ids), set(job_ids)
+        live = self._live_instances()
+        states = [state for state in STATES if state != "upserted"]
+        result = set()
+        with self._lock:
+            for i in range(0, len(image_ids), 500):
+                chunk = image_ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT image_id, job_id, owner_instance FROM images WHERE image_id IN ({','.join('?' * len(chunk))}) "
+                    f"AND state IN ({','.join('?' * len(states))})", chunk + states)
+                result.update(image_id for image_id, job_id, owner in rows if owner in live or job_id in job_ids)
+        return result
+
+    def claim_unfinished(self, job_id, include_failed=False):
+        """Hands unfinished images whose owning instance's lease has expired to job_id; returns the claimed ids.
+        Claims are compare-and-set on the previous owner, so concurrent resumers never share an image"""
+        live = self._live_instances()
+        claimed = []
+        for image_id, state, _, owner, _ in self.unfinished(include_failed):
+            if owner in live:
+                continue
+            with self._lock:
+                cursor = self._conn.execute(
+                    "UPDATE images SET job_id = ?, owner_pid = ?, owner_instance = ?, updated_at = ? "
+                    "WHERE image_id = ? AND owner_instance IS ?",
+                    (job_id, os.getpid(), INSTANCE_ID, time.time(), image_id, owner))
+                self._conn.commit()
+            if cursor.rowcount:
+                claimed.append(image_id)
+        return claimed
+
+    def lease_expiry(self):
+        """When the last current lease of another instance holding unfinished rows runs out, or None.
+        A restarted process uses it to resume rows still leased to its previous run"""
+        live = self._live_instances()
+        held = {owner for _, _, _, owner, _ in self.unfinished() if owner in live and owner != INSTANCE_ID}
+        return max((live[owner] for owner in held), default=None)
+
+    def touch(self, image_ids):
+        """Bumps updated_at of image_ids, e.g. after they were copied to another namespace, so
+        upserted_since (the reindex catch-up) sees them again"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("UPDATE images SET updated_at = ? WHERE image_id = ?",
+                                   [(now, image_id) for image_id in image_ids])
+            self._conn.commit()
+
+    def upserted_since(self, timestamp):
+        """Ids that reached "upserted" at or after timestamp"""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT image_id FROM images WHERE state = 'upserted' AND updated_at >= ?", (timestamp,))]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT state, COUNT(*) FROM images GROUP BY state").fetchall())
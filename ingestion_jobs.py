@@ -0,0 +1,213 @@
+import logging
+import queue
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+from upload_pipeline import UploadPipeline
+from helpers import get_manifest
+from metrics import INGESTION_JOBS_TOTAL
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class IngestionJob:
+    """State of one /upload-image request as it moves through the UploadPipeline stages"""
+    STAGES = ("store", "preprocess", "cluster", "caption", "embed", "upsert")
+
+    def __init__(self, temp_root, persist_dir, user_id=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.temp_dir = temp_root / self.id
+        self.persist_dir = persist_dir
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.image_errors = {}
+        self.duplicates = []
+        self.shared = []
+        self.near_duplicates = {}
+        self.result = None
+        self.stages = {stage: {"status": "pending", "done": 0, "total": None, "seconds": None}
+                       for stage in self.STAGES}
+        self._stage_started = {}
+        self._lock = threading.Lock()
+
+    def start_stage(self, stage, total=None):
+        with self._lock:
+            self._stage_started[stage] = time.perf_counter()
+            self.stages[stage].update(status="running", total=total)
+
+    def progress(self, stage, done, total=None):
+        with self._lock:
+            self.stages[stage]["done"] = done
+            if total is not None:
+                self.stages[stage]["total"] = total
+
+    def finish_stage(self, stage, done=None, status="done"):
+        with self._lock:
+            entry = self.stages[stage]
+            entry["status"] = status
+            if done is not None:
+                entry["done"] = done
+            entry["seconds"] = round(time.perf_counter() - self._stage_started.get(stage, time.perf_counter()), 3)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+                "stages": {stage: dict(entry) for stage, entry in self.stages.items()},
+                "image_errors": dict(self.image_errors),
+                "duplicates": list(self.duplicates),
+                "shared": list(self.shared),
+                "near_duplicates": dict(self.near_duplicates),
+                "error": self.error,
+                "results": self.result,
+            }
+
+
+def run_job(job):
+    """Runs caption -> embed -> upsert for images already stored in job.temp_dir"""
+    p = UploadPipeline(job.temp_dir, job.persist_dir, job_id=job.id, user_id=job.user_id)
+
+    pending = len(list(job.temp_dir.iterdir())) if job.temp_dir.exists() else 0
+    if pending == 0:
+        # every upload was a duplicate of an already ingested image
+        for stage in ("preprocess", "cluster", "caption", "embed", "upsert"):
+            job.stages[stage]["status"] = "skipped"
+        return {}
+
+    job.start_stage("preprocess", total=pending)
+    preprocessed = p.preprocess(progress=lambda done, total: job.progress("preprocess", done, total))
+    job.image_errors.update(p.preprocess_errors)
+    job.finish_stage("preprocess", done=len(preprocessed))
+
+    job.start_stage("cluster", total=len(preprocessed))
+    job.near_duplicates = p.cluster_near_duplicates()
+    job.finish_stage("cluster", done=len(job.near_duplicates))
+
+    # near-duplicates are settled against their representatives however the remaining stages end
+    try:
+        job.start_stage("caption", total=len(p.preprocessed))
+        image_caption_pairs = p.run_captioning_model(progress=lambda done, total: job.progress("caption", done, total))
+        job.image_errors.update(p.caption_errors)
+        job.finish_stage("caption", done=len(image_caption_pairs))
+
+        job.start_stage("embed", total=len(image_caption_pairs))
+        image_caption_emb_pairs = p.run_emebedding_model(image_caption_pairs,
+                                                         progress=lambda done, total: job.progress("embed", done, total))
+        job.finish_stage("embed")
+
+        job.start_stage("upsert", total=len(image_caption_emb_pairs))
+        pushed = p.push_to_vector_db(image_caption_emb_pairs)
+        for image_id in pushed["failed_ids"]:
+            job.image_errors[image_id] = "Vector DB upsert failed"
+        job.finish_stage("upsert", done=pushed["upserted"], status="failed" if pushed["failed"] else "done")
+        if pushed["failed"] and not pushed["upserted"]:
+            raise RuntimeError("Vector DB push failed")
+        return image_caption_pairs
+    finally:
+        p.settle_clusters()
+
+
+def clear_temp_dir(job):
+    """Removes job.temp_dir once the job is over. Images still in it never reached persist_dir (the job failed
+    before captioning moved them); they are moved there and left unowned so the next resume picks them up"""
+    if not job.temp_dir.exists():
+        return
+    leftovers = [file for file in job.temp_dir.iterdir() if file.is_file() and file.suffix != ".part"]
+    if leftovers:
+        manifest = get_manifest()
+        states = manifest.get(file.name for file in leftovers)
+        by_state = defaultdict(list)
+        job.persist_dir.mkdir(parents=True, exist_ok=True)
+        for file in leftovers:
+            shutil.move(str(file), str(job.persist_dir / file.name))
+            by_state[states.get(file.name, "stored")].append(file.name)
+        for state, names in by_state.items():
+            # failed images keep their error; they are retried by a resume with include_failed
+            if state not in ("upserted", "clustered", "failed"):
+                manifest.mark(names, state, job_id=job.id, owned=False)
+        logging.warning(f"Ingestion job {job.id} left {len(leftovers)} images unfinished, kept for resume")
+    shutil.rmtree(job.temp_dir, ignore_errors=True)
+
+
+class IngestionQueue:
+    """Bounded queue of IngestionJobs drained by a small pool of worker threads.
+
+    Capacity counts queued and running jobs; reserve() must succeed before the
+    upload is written to disk so callers can be turned away (backpressure)
+    without leaving orphaned files behind."""
+
+    def __init__(self, workers=1, max_depth=8, max_jobs_kept=1000):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_jobs_kept = max_jobs_kept
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_depth)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers - len(self._threads)):
+            t = threading.Thread(target=self._worker, name=f"ingest-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def reserve(self):
+        """Claims a queue slot without blocking; raises QueueFullError when at capacity"""
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError(f"Ingestion queue is full ({self.max_depth} jobs)")
+
+    def release(self):
+        self._slots.release()
+
+    def submit(self, job):
+        """Enqueues a job whose slot was already reserved"""
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs_kept:
+                self._jobs.popitem(last=False)
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active_job_ids(self):
+        """Ids of the jobs queued or running"""
+        with self._lock:
+            return {job_id for job_id, job in self._jobs.items() if job.status in ("queued", "running")}
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            logging.info(f"Ingestion job {job.id} started")
+            try:
+                job.result = run_job(job)
+                job.status = "done"
+            except Exception as e:
+                logging.error(f"Ingestion job {job.id} failed: {e}")
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.finished_at = time.time()
+                INGESTION_JOBS_TOTAL.inc(status=job.status)
+                clear_temp_dir(job)
+                self.release()
+                self._queue.task_done()
+                logging.info(f"Ingestion job {job.id} finished with status {job.status}")
@@ -0,0 +1,129 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from vector_store import matches_filter
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset("a an and are at by for from in into is it its of on or the this to with".split())
+
+
+def tokenize(text):
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in _STOPWORDS]
+
+
+class BM25Index:
+    """Incremental BM25 inverted index over image captions.
+
+    Documents are appended to a jsonl log, so the index survives restarts and other
+    worker processes pick up new documents by replaying the tail of the log on query."""
+
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.touch(exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)   # term -> {doc_id: term frequency}
+        self.doc_len = {}
+        self.doc_terms = {}
+        self.doc_path = {}
+        self.doc_metadata = {}
+        self.total_len = 0
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def _index(self, doc_id, image_path, text, metadata=None):
+        self._remove(doc_id)
+        terms = Counter(tokenize(text))
+        for term, tf in terms.items():
+            self.postings[term][doc_id] = tf
+        self.doc_terms[doc_id] = list(terms)
+        self.doc_len[doc_id] = sum(terms.values())
+        self.doc_path[doc_id] = image_path
+        self.doc_metadata[doc_id] = metadata or {}
+        self.total_len += self.doc_len[doc_id]
+
+    def _remove(self, doc_id):
+        for term in self.doc_terms.pop(doc_id, ()):
+            self.postings[term].pop(doc_id, None)
+            if not self.postings[term]:
+                del self.postings[term]
+        self.total_len -= self.doc_len.pop(doc_id, 0)
+        self.doc_path.pop(doc_id, None)
+        self.doc_metadata.pop(doc_id, None)
+
+    def _refresh(self):
+        """Replays log entries written since the last read (by this or another process)"""
+        if os.path.getsize(self.path) <= self._offset:
+            return
+        with open(self.path) as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # partially written by a concurrent writer, read it next time
+                entry = json.loads(line)
+                if entry.get("deleted"):
+                    self._remove(entry["id"])
+                else:
+                    self._index(entry["id"], entry["image_path"], entry["text"], entry.get("metadata"))
+                self._offset += len(line.encode())
+
+    def add(self, docs):
+        """docs: iterable of (doc_id, image_path, captions) or (doc_id, image_path, captions, metadata);
+        metadata is what search filters are evaluated against"""
+        with self._lock:
+            self._refresh()
+            lines = []
+            for doc_id, image_path, captions, *metadata in docs:
+                text = " ".join(captions) if isinstance(captions, list) else str(captions)
+                entry = {"id": doc_id, "image_path": image_path, "text": text}
+                if metadata and metadata[0]:
+                    entry["metadata"] = metadata[0]
+                lines.append(json.dumps(entry) + "\n")
+            with open(self.path, "a") as f:
+                f.write("".join(lines))
+            self._refresh()
+
+    def delete(self, doc_ids):
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps({"id": doc_id, "deleted": True}) + "\n" for doc_id in doc_ids))
+            self._refresh()
+
+    def search(self, query, top_k=10, filter=None):
+        """Returns [(doc_id, image_path, score)] by descending BM25 score.
+        Documents failing the metadata filter (vector store filter syntax) are never scored"""
+        with self._lock:
+            self._refresh()
+            n_docs = len(self.doc_len)
+            if n_docs == 0:
+                return []
+            avg_len = self.total_len / n_docs
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    if filter and not matches_filter(self.doc_metadata[doc_id], filter):
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avg_len)
+                    scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+            ranked = sorted(scores.items(), key=lambda item: -item[1])[:top_k]
+            return [(doc_id, self.doc_path[doc_id], score) for doc_id, score in ranked]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merges ranked lists of keys; each key scores sum(1 / (k + rank)) over the lists it appears in"""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            scores[key] += 1.0 / (k + rank)
+    return [key for key, _ in sorted(scores.items(), key=lambda item: -item[1])]
@@ -1,23 +1,41 @@
-from fastapi import FastAPI, Request, UploadFile, File
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse, JSONResponse, FileResponse, Response
 
 from authlib.integrations.starlette_client import OAuth
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.config import Config
 
 from pathlib import Path
-from typing import List
+from PIL import UnidentifiedImageError
+from typing import List, Optional
 
 from upload_pipeline import UploadPipeline
-from query_handler_pipeline import QueryHandler
-from models import SearchRequest
-from config import SECRET_KEY
+from query_handler_pipeline import QueryHandler, encode_cursor, decode_cursor
+from models import SearchRequest, SimilarRequest
+from config import SECRET_KEY, INGEST_WORKERS, INGEST_QUEUE_DEPTH
+from ingestion_jobs import IngestionJob, IngestionQueue, QueueFullError
+from config import RESUME_ON_STARTUP
+import reconcile
+from model_registry import warmup_clip_model, clip_model_stats
+from helpers import get_feature_cache, get_vector_store, get_thumbnail, get_manifest
+from thumbnails import FORMATS as THUMBNAIL_MEDIA
+from config import THUMBNAIL_SIZES, THUMBNAIL_FORMATS
+from query_cache import query_cache_stats
+from photos_importer import PhotosImport, get_photos_client, close_photos_client, start_import, get_import
+from config import PHOTOS_API_BASE, SEARCH_MAX_K
+from config import PROFILE_SLOW_REQUEST_MS, PROFILE_SAMPLE_INTERVAL_MS, PROFILE_DIR
+from metrics import REGISTRY, HTTP_REQUEST_SECONDS, Gauge, SlowRequestProfiler, serves_request
 
 import logging
 import colorlog
+import mimetypes
 import os
-import httpx
+import time
+import threading
+from contextlib import nullcontext
 
 
 # =====================================
@@ -79,20 +97,188 @@ google = oauth.register(
 )
 
 
+query_handler = None
+ingestion_queue = IngestionQueue(workers=INGEST_WORKERS, max_depth=INGEST_QUEUE_DEPTH)
+
+
+# =====================================
+# METRICS
+# =====================================
+Gauge("ingestion_queue_depth", "Ingestion jobs waiting for a worker", fn=ingestion_queue.depth)
+
+
+def _cache_metrics():
+    families = []
+    for cache_name, stats in query_cache_stats().items():
+        families.append((f"{cache_name}_cache_hits_total", "counter", f"{cache_name} cache hits", [({}, stats["hits"])]))
+        families.append((f"{cache_name}_cache_misses_total", "counter", f"{cache_name} cache misses", [({}, stats["misses"])]))
+        families.append((f"{cache_name}_cache_size", "gauge", f"Entries in the {cache_name} cache", [({}, stats["size"])]))
+    cache = get_feature_cache()
+    if cache is not None:
+        stats = cache.get_stats()
+        for kind in ("caption", "embedding"):
+            families.append((f"feature_cache_{kind}_hits_total", "counter", f"Feature cache {kind} hits",
+                             [({}, stats[f"{kind}_hits"])]))
+            families.append((f"feature_cache_{kind}_misses_total", "counter", f"Feature cache {kind} misses",
+                             [({}, stats[f"{kind}_misses"])]))
+    if query_handler is not None and query_handler.batcher is not None:
+        stats = query_handler.batcher.stats()
+        families.append(("query_batches_total", "counter", "Micro-batched text encoder passes", [({}, stats["batches"])]))
+        families.append(("query_batched_items_total", "counter", "Queries encoded by the micro-batcher", [({}, stats["items"])]))
+    return families
+
+
+REGISTRY.add_collector(_cache_metrics)
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Records latency per route; with PROFILE_SLOW_REQUEST_MS set, slow requests also get a stack profile"""
+    start = time.perf_counter()
+    profiler = nullcontext()
+    if PROFILE_SLOW_REQUEST_MS > 0 and request.url.path != "/metrics":
+        profiler = SlowRequestProfiler(f"{request.method} {request.url.path}", PROFILE_SLOW_REQUEST_MS / 1000,
+                                       PROFILE_SAMPLE_INTERVAL_MS / 1000, PROFILE_DIR)
+    status = 500
+    try:
+        async with profiler:
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                     route=getattr(route, "path", "unmatched"), status=status)
+
+
+readiness = {"status": "starting", "started_at": time.time(), "ready_at": None, "error": None}
+
+
+def _resume_interrupted():
+    try:
+        job = reconcile.resume(ingestion_queue)
+        if job is not None:
+            logging.info(f"Resuming interrupted ingestion as job {job.id}")
+    except QueueFullError:
+        logging.warning("Ingestion queue full, interrupted images will be resumed on the next start")
+
+
+def _warmup():
+    """Loads CLIP, connects the vector store and resumes interrupted ingests, then marks the worker ready"""
+    global query_handler
+    try:
+        stats = warmup_clip_model()
+        logging.info(f"Model warmup complete: {stats}")
+        query_handler = QueryHandler(micro_batching=True)
+        get_vector_store()
+        if RESUME_ON_STARTUP:
+            _resume_interrupted()
+            # rows still leased to this worker's previous run become resumable once that lease runs out
+            retry_at = get_manifest().lease_expiry()
+            if retry_at is not None:
+                retry = threading.Timer(max(0.0, retry_at - time.time()) + 1, _resume_interrupted)
+                retry.daemon = True
+                retry.start()
+        readiness.update(status="ready", ready_at=time.time())
+        logging.info(f"Worker ready in {readiness['ready_at'] - readiness['started_at']:.2f}s")
+    except Exception as e:
+        logging.error(f"Warmup failed: {e}")
+        readiness.update(status="failed", error=str(e))
+
+
+@app.on_event("startup")
+def start_warmup():
+    """Warms up in the background so the server (health and auth routes) accepts connections
+    immediately; /ready reports 503 until the models and stores are loaded"""
+    ingestion_queue.start()
+    threading.Thread(target=_warmup, name="warmup", daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await close_photos_client()
+
+
 # =====================================
 # STATIC FILES
 # =====================================
 app.mount("/photos", StaticFiles(directory="photos"), name="photos")
 
+# photo names are content hashes, so a URL's bytes never change
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+
+def thumbnail_urls(image_path):
+    """{size: /photo URL} of a search result's thumbnails, in the first configured format"""
+    name = Path(image_path).name
+    return {str(size): f"/photo/{name}?size={size}&format={THUMBNAIL_FORMATS[0]}" for size in THUMBNAIL_SIZES}
+
+
+def _etag_matches(if_none_match, etag):
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+@app.get("/photo/{image_id}")
+@serves_request
+def photo(image_id: str, request: Request, size: Optional[int] = None, format: str = THUMBNAIL_FORMATS[0]):
+    """The original photo, or with `size` (one of THUMBNAIL_SIZES) a thumbnail in `format` (webp or jpeg).
+    Responses carry a strong ETag and immutable caching; Range requests are served by FileResponse"""
+    original = Path("photos/all") / image_id
+    if image_id != original.name or not original.is_file():
+        raise HTTPException(status_code=404, detail="Photo not found")
+    if size is None:
+        path, media_type = original, mimetypes.guess_type(original.name)[0]
+    else:
+        if size not in THUMBNAIL_SIZES or format not in THUMBNAIL_MEDIA:
+            raise HTTPException(status_code=404, detail=f"Thumbnails come in sizes {list(THUMBNAIL_SIZES)} "
+                                                        f"and formats {list(THUMBNAIL_MEDIA)}")
+        path, media_type = get_thumbnail(original, size, format), THUMBNAIL_MEDIA[format][1]
+
+    headers = {"ETag": f'"{path.name}"', "Cache-Control": IMMUTABLE_CACHE}
+    if _etag_matches(request.headers.get("if-none-match", ""), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
 
 # =====================================
 # ROUTES
 # =====================================
 @app.get("/")
 def health_check():
+    """Liveness: the process is up and serving"""
     return {"message": "alive"}
 
 
+@app.get("/ready")
+def readiness_check():
+    """Readiness: models are loaded and the vector store is reachable, so search and upload are fast"""
+    status_code = 200 if readiness["status"] == "ready" else 503
+    return JSONResponse(dict(readiness), status_code=status_code)
+
+
+@app.get("/model-stats")
+def model_stats():
+    stats = clip_model_stats()
+    if query_handler is not None and query_handler.batcher is not None:
+        stats["query_batching"] = query_handler.batcher.stats()
+    return stats
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus text exposition of stage timings, request latencies, counters and cache figures"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache-stats")
+def cache_stats():
+    cache = get_feature_cache()
+    stats = query_cache_stats()
+    stats["features"] = cache.get_stats() if cache is not None else {"enabled": False}
+    return stats
+
+
 @app.get("/login")
 async def login(request: Request):
     redirect_uri = request.url_for("auth_callback")
@@ -118,6 +304,7 @@ async def auth_callback(request: Request):
     user = await google.get("https://www.googleapis.com/oauth2/v2/userinfo", token=token)
     profile = user.json()
     request.session["token"] = token
+    request.session["user_id"] = profile.get("id")
     return {"user_profile": profile, "token": token}
 
 
@@ -147,76 +334,157 @@ async def list_photos(request: Request):
     }
 
     try:
-        async with httpx.AsyncClient() as client:
-            photos_resp = await client.post(
-                "https://photoslibrary.googleapis.com/v1/mediaItems:search",
-                headers=headers,
-                json={"pageSize": 25}
-            )
-
-            photos_data = photos_resp.json()
-
-            if "error" in photos_data:
-                return {"api_error": photos_data["error"]}
-
-            if "mediaItems" not in photos_data:
-                return {"error": "No photos found in your Google Photos library."}
-
-            image_urls = [
-                {
-                    "url": item["baseUrl"] + "=d",
-                    "filename": item.get("filename", ""),
-                    "mimeType": item.get("mimeType", "")
-                }
-                for item in photos_data["mediaItems"]
-                if item.get("mimeType", "").startswith("image/")
-            ]
-
-            return {
-                "photo_count": len(image_urls),
-                "images": image_urls
+        photos_resp = await get_photos_client().post(
+            f"{PHOTOS_API_BASE}/mediaItems:search",
+            headers=headers,
+            json={"pageSize": 25}
+        )
+
+        photos_data = photos_resp.json()
+
+        if "error" in photos_data:
+            return {"api_error": photos_data["error"]}
+
+        if "mediaItems" not in photos_data:
+            return {"error": "No photos found in your Google Photos library."}
+
+        image_urls = [
+            {
+                "url": item["baseUrl"] + "=d",
+                "filename": item.get("filename", ""),
+                "mimeType": item.get("mimeType", "")
             }
+            for item in photos_data["mediaItems"]
+            if item.get("mimeType", "").startswith("image/")
+        ]
+
+        return {
+            "photo_count": len(image_urls),
+            "images": image_urls
+        }
 
     except Exception as e:
         return {"error": str(e)}
 
 
-# =====================================
-# UPLOAD + RETRIEVAL PIPELINE
-# =====================================
-@app.post("/upload-image")
-async def upload_image(files: List[UploadFile] = File(...)):
-    logging.info("=" * 60)
-    logging.info("Starting Upload Pipeline")
-    logging.info("=" * 60)
+@app.post("/drive_photos/import", status_code=202)
+@serves_request
+async def import_photos(request: Request):
+    """Imports the whole Google Photos library into the index, continuing from the last checkpoint;
+    poll /drive_photos/import/{import_id} for progress"""
+    token = request.session.get("token")
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated. Please visit /login first.")
 
-    temp_dir = Path("photos/recent")
-    persist_dir = Path("photos/all")
+    account = request.session.get("user_id") or token["access_token"]
+    photos_import = start_import(PhotosImport(token["access_token"], account, ingestion_queue,
+                                              Path("photos/recent"), Path("photos/all"),
+                                              user_id=request.session.get("user_id")))
+    return {"import_id": photos_import.id, "status_url": f"/drive_photos/import/{photos_import.id}"}
 
-    p = UploadPipeline(temp_dir, persist_dir)
-    p.store_images(files)
 
-    logging.info("Step 1: Running captioning model")
-    image_caption_pairs = p.run_captioning_model()
-    logging.info(f"Captioning complete. Results: {len(image_caption_pairs)} pairs")
+@app.get("/drive_photos/import/{import_id}")
+def import_status(import_id: str):
+    photos_import = get_import(import_id)
+    if photos_import is None:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return photos_import.to_dict()
 
-    logging.info("Step 2: Running embedding model")
-    image_caption_emb_pairs = p.run_emebedding_model(image_caption_pairs)
-    logging.info(f"Embedding complete. Results: {len(image_caption_emb_pairs)} pairs")
 
-    logging.info("Step 3: Pushing to vector database")
-    p.push_to_vector_db(image_caption_emb_pairs)
+# =====================================
+# UPLOAD + RETRIEVAL PIPELINE
+# =====================================
+@app.post("/upload-image", status_code=202)
+@serves_request
+async def upload_image(request: Request, files: List[UploadFile] = File(...)):
+    """Stores the uploads in the signed-in user's namespace and queues them for ingestion; poll /jobs/{job_id} for progress"""
+    try:
+        ingestion_queue.reserve()
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
 
-    logging.info("=" * 60)
-    logging.info("Upload Pipeline Complete")
-    logging.info("=" * 60)
+    job = IngestionJob(Path("photos/recent"), Path("photos/all"), user_id=request.session.get("user_id"))
+    logging.info(f"Queueing ingestion job {job.id} for {len(files)} files")
+    try:
+        job.start_stage("store", total=len(files))
+        p = UploadPipeline(job.temp_dir, job.persist_dir, job_id=job.id, user_id=job.user_id)
+        await run_in_threadpool(p.store_images, files)
+        job.duplicates = p.duplicates
+        job.shared = p.shared
+        job.finish_stage("store", done=len(p.stored_files))
+    except Exception:
+        ingestion_queue.release()
+        raise
+
+    ingestion_queue.submit(job)
+    return {"job_id": job.id, "status_url": f"/jobs/{job.id}"}
+
+
+@app.post("/reconcile")
+@serves_request
+def reconcile_index(repair: bool = False):
+    """Reports files in photos/all missing from the index; with repair=true they are re-ingested"""
+    report = reconcile.scan(repair=repair, ingestion_queue=ingestion_queue)
+    if repair and report["missing"]:
+        try:
+            job = reconcile.resume(ingestion_queue)
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+        report["job_id"] = job.id if job is not None else None
+    return report
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+# Plain def so FastAPI runs it in the threadpool and CLIP inference never blocks the event loop
+@app.post("/search-endpoint")
+@serves_request
+def search_endpoint(search_phrase: SearchRequest, request: Request):
+    """Searches the signed-in user's photos (anonymous uploads without a session)"""
+    offset = search_phrase.offset
+    if search_phrase.cursor:
+        try:
+            offset = decode_cursor(search_phrase.cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    q = query_handler or QueryHandler()
+    images_to_show, next_offset = q.search(search_phrase.search_phrase, k=search_phrase.k, offset=offset,
+                                           filters=search_phrase.metadata_filter(),
+                                           user_id=request.session.get("user_id"))
+    return {
+        "retrieved_images": images_to_show,
+        "thumbnails": [thumbnail_urls(image_path) for image_path in images_to_show],
+        "next_cursor": encode_cursor(next_offset) if next_offset is not None else None,
+    }
 
-    return image_caption_pairs
 
+@app.post("/similar")
+@serves_request
+def similar_images(similar: SimilarRequest, request: Request):
+    """Neighbours of already indexed images from their stored vectors; batch a gallery page's ids in one call"""
+    image_ids = [Path(image_id).name for image_id in similar.image_ids]
+    q = query_handler or QueryHandler()
+    results = q.similar_to(image_ids, k=similar.k, user_id=request.session.get("user_id"))
+    return {
+        "results": results,
+        "missing": [image_id for image_id in image_ids if image_id not in results],
+    }
 
-@app.post("/search-endpoint")
-async def search_endpoint(search_phrase: SearchRequest):
-    q = QueryHandler()
-    q_emb = q.generate_clip_embeddings(search_phrase.search_phrase)
-    images_to_show = q.retrieve_top_k(q_emb=q_emb, k=5)
-    return {"retrieved_images": images_to_show}
+
+@app.post("/similar/upload")
+@serves_request
+def similar_to_upload(request: Request, file: UploadFile = File(...), k: int = Query(5, ge=1, le=SEARCH_MAX_K)):
+    """Neighbours of an uploaded image that is not added to the index"""
+    q = query_handler or QueryHandler()
+    try:
+        images = q.similar_to_upload(file.file, k=k, user_id=request.session.get("user_id"))
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=400, detail="Not a readable image")
+    return {"retrieved_images": images, "thumbnails": [thumbnail_urls(image_path) for image_path in images]}
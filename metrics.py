@@ -0,0 +1,272 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from pathlib import Path
+
+# Latency buckets in seconds, from a cached query lookup up to a large captioning batch
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_str(labelnames, values):
+    if not labelnames:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)) + "}"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_str(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge that is either set directly or read from `fn` at scrape time"""
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self):
+        if self.fn is not None:
+            try:
+                self.set(self.fn())
+            except Exception as e:
+                logging.debug(f"Gauge {self.name} callback failed: {e}")
+        return super().render()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, entry["counts"]):
+                    lines.append(f"{self.name}_bucket{_label_str(self.labelnames + ('le',), key + (bound,))} {count}")
+                lines.append(f"{self.name}_bucket{_label_str(self.labelnames + ('le',), key + ('+Inf',))} {entry['count']}")
+                lines.append(f"{self.name}_sum{_label_str(self.labelnames, key)} {entry['sum']}")
+                lines.append(f"{self.name}_count{_label_str(self.labelnames, key)} {entry['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def add_collector(self, fn):
+        """fn() returns [(name, type, help, [(labels dict, value), ...])] computed at scrape time,
+        for figures other modules already keep (cache hit counts, batcher stats)"""
+        self._collectors.append(fn)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        for fn in self._collectors:
+            try:
+                families = fn()
+            except Exception as e:
+                logging.warning(f"Metrics collector {fn.__name__} failed: {e}")
+                continue
+            for name, type, help, samples in families:
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f"{name}{_label_str(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PIPELINE_STAGE_SECONDS = Histogram("upload_pipeline_stage_seconds", "Time spent in each UploadPipeline stage", ["stage"])
+QUERY_STAGE_SECONDS = Histogram("query_stage_seconds", "Time spent in each step of a search", ["stage"])
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds", "Request latency by route", ["method", "route", "status"])
+IMAGES_TOTAL = Counter("images_total", "Images by ingestion outcome", ["outcome"])
+GEMINI_REQUESTS_TOTAL = Counter("gemini_requests_total", "Captioning calls to Gemini by result", ["result"])
+GEMINI_RETRIES_TOTAL = Counter("gemini_retries_total", "Captioning calls retried after a transient error", ["status"])
+INGESTION_JOBS_TOTAL = Counter("ingestion_jobs_total", "Finished ingestion jobs by status", ["status"])
+
+
+@contextmanager
+def span(stage, histogram=PIPELINE_STAGE_SECONDS, **fields):
+    """Times the block into histogram{stage=...} and logs it as one structured line"""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        histogram.observe(seconds, stage=stage)
+        extra = "".join(f" {key}={value}" for key, value in fields.items())
+        logging.debug(f"span stage={stage} status={status} seconds={seconds:.4f}{extra}")
+
+
+def timed(stage, histogram=PIPELINE_STAGE_SECONDS):
+    """Decorator form of span"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, histogram):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SlowRequestProfiler:
+    """Sampling profiler for one request: a background thread records every thread's stack
+    each `interval` seconds, and if the request took longer than `threshold` the samples are
+    written to out_dir in collapsed-stack format (one "frame;frame;frame count" line per stack,
+    readable by flamegraph.pl / speedscope). Nothing is written for fast requests.
+
+    A request may be served on the event loop or in a threadpool worker, and other requests
+    run alongside it, so each stack's root frame is its thread's name and the flame graph
+    splits by thread. Threads that ran a @serves_request endpoint for this request are
+    marked "request"; use `async with` from middleware so stopping and writing run off the
+    event loop and the endpoint can find the profiler through its context"""
+
+    def __init__(self, name, threshold, interval, out_dir):
+        self.name = name
+        self.threshold = threshold
+        self.interval = interval
+        self.out_dir = Path(out_dir)
+        self.samples = _Tally()
+        self.request_threads = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="slow-request-profiler", daemon=True)
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[thread_id, names.get(thread_id, str(thread_id)), ";".join(reversed(stack))] += 1
+
+    def _folded(self):
+        # Tagged at write time: the endpoint may mark its thread after sampling started
+        lines = _Tally()
+        for (thread_id, name, stack), count in self.samples.items():
+            root = f"thread {name} (request)" if thread_id in self.request_threads else f"thread {name}"
+            lines[f"{root};{stack}"] += count
+        return "".join(f"{stack} {count}\n" for stack, count in lines.most_common())
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        seconds = time.perf_counter() - self._start
+        if seconds >= self.threshold and self.samples:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+            safe_name = "".join(c if c.isalnum() else "_" for c in self.name).strip("_")
+            path = self.out_dir / f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_name}-{int(seconds * 1000)}ms.folded"
+            path.write_text(self._folded())
+            logging.warning(f"Slow request {self.name} took {seconds:.2f}s, profile written to {path}")
+        return False
+
+    async def __aenter__(self):
+        self._token = _active_profiler.set(self)
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        _active_profiler.reset(self._token)
+        # Joining the sampler and writing the profile would stall every request on the loop
+        return await asyncio.to_thread(self.__exit__, *exc)
+
+
+_active_profiler = contextvars.ContextVar("active_profiler", default=None)
+
+
+def serves_request(fn):
+    """Marks the thread running endpoint `fn` as serving the request in an active SlowRequestProfiler.
+    Plain def endpoints run in a threadpool worker, async ones on the event loop"""
+    def mark():
+        profiler = _active_profiler.get()
+        if profiler is not None:
+            profiler.request_threads.add(threading.get_ident())
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            mark()
+            return await fn(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        mark()
+        return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,148 @@
+import copy
+import logging
+import resource
+import threading
+import time
+
+from config import CLIP_MODEL_NAME, CLIP_INFERENCE_MODE, TORCH_INTRA_OP_THREADS, TORCH_INTER_OP_THREADS
+
+INFERENCE_MODES = ("fp32", "int8")
+
+# One entry per (checkpoint name, inference mode), shared by every pipeline in the process
+_registry = {}
+_stats = {}
+_lock = threading.Lock()
+_threads_configured = False
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _tensor_bytes(value):
+    # quantized Linear layers keep their int8 weight and bias as a tuple in the state dict
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(v) for v in value)
+    if hasattr(value, "element_size"):
+        return value.numel() * value.element_size()
+    return 0
+
+
+def _model_size_mb(model):
+    """Bytes held by the weights and buffers of a torch module (quantized ones included), in MB"""
+    n_bytes = sum(_tensor_bytes(value) for value in model.state_dict().values())
+    return n_bytes / (1024 * 1024)
+
+
+def configure_torch_threads(intra_op=TORCH_INTRA_OP_THREADS, inter_op=TORCH_INTER_OP_THREADS):
+    """Sizes this process's torch thread pools (0 keeps the default). The inter-op pool can only
+    be sized before torch first uses it, so this runs before the first model is loaded"""
+    global _threads_configured
+    import torch
+    _threads_configured = True
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            logging.warning(f"Could not set inter-op threads to {inter_op}: {e}")
+    logging.info(f"torch using {torch.get_num_threads()} intra-op / {torch.get_num_interop_threads()} inter-op threads")
+
+
+def quantize_clip(model):
+    """Dynamic int8 quantization of every Linear layer in the text and vision transformers, in place.
+    Weights are stored as int8 and activations are quantized per batch at run time, so no
+    calibration data is needed; the projection heads and embeddings stay fp32"""
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+    for name in ("text_model", "vision_model"):
+        setattr(model, name, quantize_dynamic(getattr(model, name), {torch.nn.Linear}, dtype=torch.qint8))
+    return model
+
+
+def _load(model_name, mode):
+    # torch/transformers take seconds to import; only pay for them when a model is needed
+    from transformers import CLIPProcessor, CLIPModel
+    if mode not in INFERENCE_MODES:
+        raise ValueError(f"Unknown CLIP inference mode {mode!r}, expected one of {INFERENCE_MODES}")
+    rss_before = _peak_rss_mb()
+    start = time.perf_counter()
+
+    fp32 = _registry.get((model_name, "fp32"))
+    if mode != "fp32" and fp32 is not None:
+        # quantize a copy of the fp32 model already in memory (a registered stand-in, or a side-by-side check)
+        model, processor = copy.deepcopy(fp32[0]), fp32[1]
+    else:
+        model = CLIPModel.from_pretrained(model_name)
+        processor = CLIPProcessor.from_pretrained(model_name)
+    model.eval()
+    if mode == "int8":
+        quantize_clip(model)
+
+    load_seconds = time.perf_counter() - start
+    _stats[(model_name, mode)] = {
+        "model_name": model_name,
+        "mode": mode,
+        "load_seconds": round(load_seconds, 3),
+        "weights_mb": round(_model_size_mb(model), 1),
+        "rss_delta_mb": round(_peak_rss_mb() - rss_before, 1),
+        "warmup_seconds": None,
+    }
+    logging.info(f"Loaded {model_name} ({mode}) in {load_seconds:.2f}s ({_stats[(model_name, mode)]['weights_mb']} MB of weights)")
+    return model, processor
+
+
+def get_clip_model(model_name=CLIP_MODEL_NAME, mode=CLIP_INFERENCE_MODE):
+    """Returns the process-wide (model, processor) pair for an inference mode, loading it on first use"""
+    entry = _registry.get((model_name, mode))
+    if entry is None:
+        with _lock:
+            entry = _registry.get((model_name, mode))
+            if entry is None:
+                if not _threads_configured:
+                    configure_torch_threads()
+                entry = _load(model_name, mode)
+                _registry[(model_name, mode)] = entry
+    return entry
+
+
+def register_clip_model(model, processor, model_name=CLIP_MODEL_NAME):
+    """Installs an already built fp32 (model, processor) pair, e.g. a small stand-in for offline benchmarks.
+    Quantized modes are derived from it on first use"""
+    with _lock:
+        _registry[(model_name, "fp32")] = (model, processor)
+        _stats[(model_name, "fp32")] = {
+            "model_name": model_name,
+            "mode": "fp32",
+            "load_seconds": 0.0,
+            "weights_mb": round(_model_size_mb(model), 1),
+            "rss_delta_mb": 0.0,
+            "warmup_seconds": None,
+        }
+
+
+def warmup_clip_model(model_name=CLIP_MODEL_NAME, mode=CLIP_INFERENCE_MODE):
+    """Loads the model and runs one dummy forward pass so the first real request is not slow"""
+    import torch
+    from PIL import Image
+    model, processor = get_clip_model(model_name, mode)
+    start = time.perf_counter()
+    inputs = processor(text=["warmup"],
+                       images=Image.new("RGB", (224, 224)),
+                       return_tensors="pt",
+                       padding=True)
+    with torch.no_grad():
+        model(**inputs)
+    _stats[(model_name, mode)]["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    logging.info(f"Warmed up {model_name} ({mode}) in {_stats[(model_name, mode)]['warmup_seconds']}s")
+    return clip_model_stats()
+
+
+def clip_model_stats():
+    """Load time and memory figures for every model loaded in this process"""
+    return {
+        "models": list(_stats.values()),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
@@ -1,4 +1,41 @@
-from pydantic import BaseModel
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+from config import SEARCH_MAX_K, SIMILAR_MAX_IDS
 
 class SearchRequest(BaseModel):
-    search_phrase: str
\ No newline at end of file
+    search_phrase: str
+    k: int = Field(5, ge=1, le=SEARCH_MAX_K)
+    offset: int = Field(0, ge=0)
+    # opaque token from a previous response's next_cursor; takes precedence over offset
+    cursor: Optional[str] = None
+    # capture (EXIF) and upload time bounds: after is inclusive, before exclusive
+    taken_after: Optional[datetime] = None
+    taken_before: Optional[datetime] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+    mime_types: Optional[List[str]] = None
+
+    def metadata_filter(self):
+        """The date and type constraints as a vector store metadata filter, or None"""
+        conditions = {}
+        for field, after, before in (("taken_at", self.taken_after, self.taken_before),
+                                     ("uploaded_at", self.uploaded_after, self.uploaded_before)):
+            bounds = {}
+            if after is not None:
+                bounds["$gte"] = int(after.timestamp())
+            if before is not None:
+                bounds["$lt"] = int(before.timestamp())
+            if bounds:
+                conditions[field] = bounds
+        if self.mime_types:
+            conditions["mime_type"] = {"$in": [mime_type.lower() for mime_type in self.mime_types]}
+        return conditions or None
+
+
+class SimilarRequest(BaseModel):
+    # ids of indexed images (file names, or their photos/all/... paths)
+    image_ids: List[str] = Field(..., min_length=1, max_length=SIMILAR_MAX_IDS)
+    k: int = Field(5, ge=1, le=SEARCH_MAX_K)
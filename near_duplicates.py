@@ -0,0 +1,197 @@
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+
+def dhash(img, hash_size=8):
+    """64-bit difference hash: sign of the horizontal gradient on a (hash_size + 1) x hash_size
+    grayscale thumbnail. Survives re-encoding, resizing and small shifts, so burst shots of
+    the same scene land a few bits apart"""
+    small = np.asarray(img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming(phash, phashes):
+    """Bit distance from one hash to each of an array of uint64 hashes"""
+    xor = np.bitwise_xor(np.asarray(phashes, dtype=np.uint64), np.uint64(phash))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def _to_sql(phash):
+    # SQLite integers are signed 64-bit
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+
+def _from_sql(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class ClusterIndex:
+    """Perceptual hash, cluster and (optionally) CLIP image embedding of every ingested image.
+
+    The most recent `recent` hashes are kept in memory for candidate lookups and reloaded
+    when another process has added rows. Each cluster has one representative, the image
+    that is captioned and indexed; the others are only recorded here. Clusters never span
+    users, so every user's own copy of a scene stays searchable in their namespace."""
+
+    def __init__(self, path, recent=5000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.recent = recent
+        self.lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                image_id TEXT PRIMARY KEY, phash INTEGER, cluster_id TEXT, representative INTEGER,
+                embedding BLOB, created_at REAL, user_id TEXT);
+            CREATE INDEX IF NOT EXISTS images_cluster ON images (cluster_id);
+        """)
+        if "user_id" not in [row[1] for row in self._conn.execute("PRAGMA table_info(images)")]:
+            # indexes created before clusters were per user; another process may be migrating at the same time
+            try:
+                self._conn.execute("ALTER TABLE images ADD COLUMN user_id TEXT")
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e):
+                    raise
+        self._loaded_rowid = None
+        self._ids, self._hashes, self._clusters, self._users = [], np.zeros(0, dtype=np.uint64), [], np.zeros(0, dtype=object)
+
+    def _refresh(self):
+        last_rowid = self._conn.execute("SELECT MAX(rowid) FROM images").fetchone()[0]
+        if last_rowid == self._loaded_rowid:
+            return
+        rows = self._conn.execute("SELECT image_id, phash, cluster_id, user_id FROM images ORDER BY rowid DESC LIMIT ?",
+                                  (self.recent,)).fetchall()
+        self._ids = [row[0] for row in rows]
+        self._hashes = np.array([_from_sql(row[1]) for row in rows], dtype=np.uint64)
+        self._clusters = [row[2] for row in rows]
+        self._users = np.array([row[3] for row in rows], dtype=object)
+        self._loaded_rowid = last_rowid
+
+    def candidates(self, phash, max_distance, user_id=None):
+        """user_id's recent images within max_distance bits, closest first, as (image_id, cluster_id, distance)"""
+        with self.lock:
+            self._refresh()
+            if not self._ids:
+                return []
+            distances = hamming(phash, self._hashes)
+            close = np.flatnonzero((distances <= max_distance) & (self._users == user_id))
+            return sorted(((self._ids[i], self._clusters[i], int(distances[i])) for i in close), key=lambda c: c[2])
+
+    def add(self, image_id, phash, cluster_id=None, embedding=None, user_id=None):
+        """Records user_id's image; without cluster_id it starts (and represents) a new cluster. Returns the cluster id"""
+        representative = cluster_id is None
+        cluster_id = cluster_id or uuid.uuid4().hex
+        blob = np.asarray(embedding, dtype=np.float16).tobytes() if embedding is not None else None
+        with self.lock:
+            self._conn.execute("""
+                INSERT OR REPLACE INTO images (image_id, phash, cluster_id, representative, embedding, created_at, user_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (image_id, _to_sql(phash), cluster_id, int(representative), blob, time.time(), user_id))
+            self._conn.commit()
+        return cluster_id
+
+    def set_embeddings(self, embeddings):
+        with self.lock:
+            self._conn.executemany("UPDATE images SET embedding = ? WHERE image_id = ?",
+                                   [(np.asarray(e, dtype=np.float16).tobytes(), image_id)
+                                    for image_id, e in embeddings.items()])
+            self._conn.commit()
+
+    def _select(self, columns, image_ids):
+        image_ids = list(image_ids)
+        rows = []
+        with self.lock:
+            for i in range(0, len(image_ids), 500):
+                chunk = image_ids[i:i + 500]
+                rows += self._conn.execute(
+                    f"SELECT image_id, {columns} FROM images WHERE image_id IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+        return rows
+
+    def embeddings(self, image_ids):
+        """Stored image embeddings as float32 arrays; images without one are left out"""
+        return {image_id: np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+                for image_id, blob in self._select("embedding", image_ids) if blob is not None}
+
+    def clusters(self, image_ids):
+        """{image_id: (cluster_id, is_representative)} for the images that are recorded"""
+        return {image_id: (cluster_id, bool(representative))
+                for image_id, cluster_id, representative in self._select("cluster_id, representative", image_ids)}
+
+    def cluster_users(self, image_ids):
+        """{image_id: user_id whose cluster it was recorded in} for the images that are recorded"""
+        return dict(self._select("user_id", image_ids))
+
+    def promote(self, image_id):
+        """Makes image_id the representative of its cluster, e.g. when the current one could not be indexed"""
+        with self.lock:
+            row = self._conn.execute("SELECT cluster_id FROM images WHERE image_id = ?", (image_id,)).fetchone()
+            if row is None:
+                return
+            self._conn.execute("UPDATE images SET representative = (image_id = ?) WHERE cluster_id = ?", (image_id, row[0]))
+            self._conn.commit()
+
+    def members(self, cluster_id):
+        """Image ids in a cluster, representative first"""
+        with self.lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT image_id FROM images WHERE cluster_id = ? ORDER BY representative DESC, created_at",
+                (cluster_id,))]
+
+
+
+def assign_clusters(items, index, embed_fn, max_distance=10, min_similarity=0.95, user_id=None):
+    """Clusters user_id's items = {image_id: phash} against their indexed images and each other.
+
+    A perceptual-hash match only nominates candidates; an image joins a cluster when its
+    CLIP image embedding is also within min_similarity (cosine) of a candidate. embed_fn(ids)
+    returns {image_id: normalized embedding} and is called once, for just the images that
+    have hash candidates and the candidates without a stored embedding.
+    Returns {image_id: representative id} for the images that joined an existing cluster"""
+    with index.lock:
+        # images seen before (a resumed job) keep the cluster they were given
+        known = index.clusters(items)
+        joined = {image_id: index.members(cluster_id)[0]
+                  for image_id, (cluster_id, representative) in known.items() if not representative}
+        names = [image_id for image_id in items if image_id not in known]
+
+        candidates = {}
+        for i, image_id in enumerate(names):
+            found = [c for c in index.candidates(items[image_id], max_distance, user_id) if c[0] != image_id]
+            if i:
+                distances = hamming(items[image_id], [items[other] for other in names[:i]])
+                found += [(other, None, int(d)) for other, d in zip(names[:i], distances) if d <= max_distance]
+            if found:
+                candidates[image_id] = sorted(found, key=lambda c: c[2])
+
+        embeddings = {}
+        if candidates:
+            needed = set(candidates) | {c[0] for found in candidates.values() for c in found}
+            embeddings = index.embeddings(needed)
+            embeddings.update(embed_fn([image_id for image_id in needed if image_id not in embeddings]))
+
+        cluster_ids = {}
+        for image_id in names:
+            cluster_id = None
+            for other, other_cluster, _ in candidates.get(image_id, []):
+                if image_id in embeddings and other in embeddings and \
+                        float(np.dot(embeddings[image_id], embeddings[other])) >= min_similarity:
+                    cluster_id = other_cluster or cluster_ids.get(other)
+                    if cluster_id is not None:
+                        break
+            cluster_ids[image_id] = index.add(image_id, items[image_id], cluster_id, embeddings.get(image_id), user_id)
+            if cluster_id is not None:
+                joined[image_id] = index.members(cluster_id)[0]
+        # keep embeddings of the candidates that had to be computed for later confirmations
+        stored = {image_id: e for image_id, e in embeddings.items() if image_id not in cluster_ids}
+        if stored:
+            index.set_embeddings(stored)
+        return joined
@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import httpx
+
+from config import PHOTOS_API_BASE, PHOTOS_PAGE_SIZE, PHOTOS_DOWNLOAD_CONCURRENCY, PHOTOS_DOWNLOAD_RETRIES
+from config import PHOTOS_IMPORT_STATE_DIR
+from helpers import UPLOAD_CHUNK_SIZE, commit_part, get_manifest, share_indexed
+from ingestion_jobs import IngestionJob, QueueFullError
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_client = None
+
+
+def get_photos_client():
+    """Returns the process-wide pooled HTTP/2 client used for the Photos API and downloads"""
+    global _client
+    if _client is None:
+        limits = httpx.Limits(max_connections=PHOTOS_DOWNLOAD_CONCURRENCY * 2,
+                              max_keepalive_connections=PHOTOS_DOWNLOAD_CONCURRENCY)
+        _client = httpx.AsyncClient(http2=True, limits=limits, timeout=httpx.Timeout(30.0, connect=10.0))
+    return _client
+
+
+async def close_photos_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+class ImportCheckpoint:
+    """Per-account import progress under state_dir.
+
+    <account>.json holds the page token to continue from; <account>.ids is an
+    append-only log of media item ids already handed to the ingestion queue, so
+    later passes over the library skip them without downloading"""
+
+    def __init__(self, state_dir, account):
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        account = hashlib.sha1(account.encode()).hexdigest()[:16]
+        self.state_path = self.state_dir / f"{account}.json"
+        self.ids_path = self.state_dir / f"{account}.ids"
+        self.state = json.loads(self.state_path.read_text()) if self.state_path.exists() else {}
+        self.seen = set(self.ids_path.read_text().split()) if self.ids_path.exists() else set()
+
+    @property
+    def page_token(self):
+        return self.state.get("page_token")
+
+    def save(self, page_token, media_ids, **fields):
+        """Records media_ids as imported, then atomically moves the checkpoint to page_token"""
+        if media_ids:
+            with open(self.ids_path, "a") as f:
+                f.write("".join(f"{media_id}\n" for media_id in media_ids))
+            self.seen.update(media_ids)
+        self.state.update(fields, page_token=page_token, updated_at=time.time())
+        tmp_path = self.state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.state))
+        os.replace(tmp_path, self.state_path)
+
+
+class PhotosImport:
+    """Streams a Google Photos library into the ingestion queue, one IngestionJob per page.
+
+    Pages are followed through nextPageToken. Each page's images are downloaded
+    concurrently (bounded by a semaphore) over the shared pooled client, streamed
+    straight to the job's temp dir under their content hash and submitted, and only
+    then is the page token checkpointed. A slot on the ingestion queue is reserved
+    before a page is fetched, so paging slows down to the pace of ingestion."""
+
+    def __init__(self, access_token, account, ingestion_queue, temp_root, persist_dir,
+                 api_base=PHOTOS_API_BASE, page_size=PHOTOS_PAGE_SIZE, concurrency=PHOTOS_DOWNLOAD_CONCURRENCY,
+                 state_dir=PHOTOS_IMPORT_STATE_DIR, client=None, max_pages=None, user_id=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.access_token = access_token
+        self.ingestion_queue = ingestion_queue
+        self.temp_root = temp_root
+        self.persist_dir = persist_dir
+        self.api_base = api_base.rstrip("/")
+        self.page_size = min(page_size, 100)
+        self.concurrency = concurrency
+        self.client = client
+        self.max_pages = max_pages
+        self.checkpoint = ImportCheckpoint(state_dir, account)
+        self.status = "queued"
+        self.error = None
+        self.stats = {"pages": 0, "downloaded": 0, "already_imported": 0, "duplicates": 0,
+                      "skipped_non_image": 0, "failed": 0, "bytes": 0}
+        self.failures = {}
+        self.job_ids = []
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "import_id": self.id,
+            "status": self.status,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stats": dict(self.stats),
+            "failures": dict(self.failures),
+            "job_ids": list(self.job_ids),
+            "page_token": self.checkpoint.page_token,
+            "error": self.error,
+        }
+
+    async def run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        client = self.client or get_photos_client()
+        try:
+            page_token = self.checkpoint.page_token
+            while True:
+                await self._reserve_slot()
+                try:
+                    page = await self._list_page(client, page_token)
+                    job = await self._import_page(client, page.get("mediaItems", []))
+                except BaseException:
+                    self.ingestion_queue.release()
+                    raise
+                page_token = page.get("nextPageToken")
+                self.stats["pages"] += 1
+                # a finished pass starts over next time; already imported items are skipped cheaply
+                await asyncio.to_thread(self.checkpoint.save, page_token, job["media_ids"],
+                                        completed=page_token is None)
+                if page_token is None or (self.max_pages and self.stats["pages"] >= self.max_pages):
+                    break
+            self.status = "done"
+        except Exception as e:
+            logging.error(f"Photos import {self.id} failed: {e}")
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            self.finished_at = time.time()
+            logging.info(f"Photos import {self.id} finished with status {self.status}: {self.stats}")
+        return self.to_dict()
+
+    async def _reserve_slot(self):
+        while True:
+            try:
+                self.ingestion_queue.reserve()
+                return
+            except QueueFullError:
+                await asyncio.sleep(1)
+
+    async def _list_page(self, client, page_token):
+        body = {"pageSize": self.page_size}
+        if page_token:
+            body["pageToken"] = page_token
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        response = await self._request(client, "POST", f"{self.api_base}/mediaItems:search", headers=headers, json=body)
+        return response.json()
+
+    async def _request(self, client, method, url, **kwargs):
+        for attempt in range(PHOTOS_DOWNLOAD_RETRIES + 1):
+            try:
+                response = await client.request(method, url, **kwargs)
+                if response.status_code not in RETRYABLE_STATUS or attempt == PHOTOS_DOWNLOAD_RETRIES:
+                    response.raise_for_status()
+                    return response
+            except httpx.TransportError:
+                if attempt == PHOTOS_DOWNLOAD_RETRIES:
+                    raise
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+    async def _import_page(self, client, items):
+        """Downloads one page's new images into a fresh job and submits it (the slot is already reserved)"""
+        images = []
+        for item in items:
+            if not item.get("mimeType", "").startswith("image/"):
+                self.stats["skipped_non_image"] += 1
+            elif item["id"] in self.checkpoint.seen:
+                self.stats["already_imported"] += 1
+            else:
+                images.append(item)
+
+        job = IngestionJob(self.temp_root, self.persist_dir, user_id=self.user_id)
+        await asyncio.to_thread(job.temp_dir.mkdir, parents=True, exist_ok=True)
+        job.start_stage("store", total=len(images))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _download(item):
+            async with semaphore:
+                try:
+                    return item, await self._download(client, item, job.temp_dir)
+                except Exception as e:
+                    logging.warning(f"Photos import: download of {item.get('filename', item['id'])} failed: {e}")
+                    self.failures[item["id"]] = str(e)
+                    self.stats["failed"] += 1
+                    return item, None
+
+        results = await asyncio.gather(*(_download(item) for item in images))
+        stored = [saved[0] for _, saved in results if saved and saved[1]]
+        duplicates = [saved[0] for _, saved in results if saved and not saved[1]]
+        job.duplicates = [item.get("filename", item["id"]) for item, saved in results if saved and not saved[1]]
+        self.stats["downloaded"] += len(stored)
+        self.stats["duplicates"] += len(job.duplicates)
+        if duplicates:
+            job.shared, staged = await asyncio.to_thread(share_indexed, duplicates, self.user_id,
+                                                         self.persist_dir, job.temp_dir)
+            stored += staged
+        job.finish_stage("store", done=len(stored))
+        await asyncio.to_thread(self._record_stored, stored, job.id)
+
+        if stored:
+            self.ingestion_queue.submit(job)
+            self.job_ids.append(job.id)
+        else:
+            await asyncio.to_thread(job.temp_dir.rmdir)
+            self.ingestion_queue.release()
+        # failed downloads are retried on the next import
+        return {"job": job, "media_ids": [item["id"] for item, saved in results if saved is not None]}
+
+    def _record_stored(self, stored, job_id):
+        get_manifest().mark(stored, "stored", job_id=job_id)
+        get_manifest().add_user(stored, self.user_id)
+
+    async def _download(self, client, item, save_dir):
+        """Streams the original bytes to save_dir; returns (content-hash name, False for a duplicate).
+        Hashing and file writes run in worker threads so the event loop only waits on the network"""
+        ext = os.path.splitext(item.get("filename", ""))[1].lower() or mimetypes.guess_extension(item["mimeType"]) or ""
+        part_path = save_dir / f".{uuid.uuid4()}.part"
+        for attempt in range(PHOTOS_DOWNLOAD_RETRIES + 1):
+            digest = hashlib.sha256()
+            try:
+                async with client.stream("GET", item["baseUrl"] + "=d") as response:
+                    if response.status_code in RETRYABLE_STATUS and attempt < PHOTOS_DOWNLOAD_RETRIES:
+                        await asyncio.sleep(min(2 ** attempt, 30))
+                        continue
+                    response.raise_for_status()
+                    buffer = await asyncio.to_thread(open, part_path, "wb")
+
+                    def _write(chunk):
+                        digest.update(chunk)
+                        buffer.write(chunk)
+
+                    try:
+                        async for chunk in response.aiter_bytes(UPLOAD_CHUNK_SIZE):
+                            await asyncio.to_thread(_write, chunk)
+                    finally:
+                        await asyncio.to_thread(buffer.close)
+                break
+            except httpx.TransportError:
+                if attempt == PHOTOS_DOWNLOAD_RETRIES:
+                    await asyncio.to_thread(part_path.unlink, missing_ok=True)
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except Exception:
+                await asyncio.to_thread(part_path.unlink, missing_ok=True)
+                raise
+        self.stats["bytes"] += (await asyncio.to_thread(part_path.stat)).st_size
+        return await asyncio.to_thread(commit_part, part_path, digest.hexdigest(), ext, save_dir)
+
+
+_imports = OrderedDict()
+
+
+def start_import(photos_import, max_kept=100):
+    """Runs a PhotosImport in the background on the running event loop.
+    An account's import that is still running is returned instead of starting a second one"""
+    for running in _imports.values():
+        if running.status in ("queued", "running") and running.checkpoint.state_path == photos_import.checkpoint.state_path:
+            return running
+    _imports[photos_import.id] = photos_import
+    while len(_imports) > max_kept:
+        _imports.popitem(last=False)
+    photos_import.task = asyncio.create_task(photos_import.run())
+    return photos_import
+
+
+def get_import(import_id):
+    return _imports.get(import_id)
@@ -0,0 +1,96 @@
+import io
+import logging
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from PIL import Image, ImageOps
+
+from near_duplicates import dhash
+
+
+class PreprocessedImage:
+    """One decoded upload: a bounded-size JPEG for captioning, the CLIP pixel tensor (None when
+    it was not kept, see clip_pixels) and a perceptual hash"""
+    def __init__(self, name, caption_jpeg, pixel_values, size, phash=None):
+        self.name = name
+        self.caption_jpeg = caption_jpeg
+        self.pixel_values = pixel_values
+        self.size = size
+        self.phash = phash
+
+    def clip_pixels(self, clip_processor):
+        """The CLIP pixel tensor, rebuilt from the caption JPEG if it was not kept"""
+        if self.pixel_values is not None:
+            return self.pixel_values
+        with Image.open(io.BytesIO(self.caption_jpeg)) as img:
+            return clip_processor.image_processor(images=img.convert("RGB"), return_tensors="pt")["pixel_values"][0]
+
+
+def decode_image(path, max_side):
+    """Decodes an image at reduced size and applies its EXIF orientation.
+    For JPEGs, draft mode lets libjpeg scale by 1/2, 1/4 or 1/8 while decoding,
+    so a 12MP photo is never fully materialized"""
+    with Image.open(path) as img:
+        scale = max_side / max(img.size)
+        if scale < 1:
+            img.draft("RGB", (int(img.width * scale), int(img.height * scale)))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((max_side, max_side), Image.BICUBIC)
+    return img
+
+
+_EXIF_IFD, _EXIF_DATETIME_ORIGINAL, _EXIF_DATETIME = 0x8769, 36867, 306
+
+
+def image_metadata(path):
+    """Filterable metadata for an image file, read from the file header only: mime_type, uploaded_at
+    (the stored file's mtime) and taken_at (EXIF capture time), times as epoch seconds.
+    Unknown fields are left out, since vector stores reject null metadata"""
+    metadata = {"uploaded_at": int(os.path.getmtime(path))}
+    mime_type = mimetypes.guess_type(str(path))[0]
+    try:
+        with Image.open(path) as img:
+            mime_type = img.get_format_mimetype() or mime_type
+            exif = img.getexif()
+            taken = exif.get_ifd(_EXIF_IFD).get(_EXIF_DATETIME_ORIGINAL) or exif.get(_EXIF_DATETIME)
+        if taken:
+            metadata["taken_at"] = int(datetime.strptime(str(taken).strip("\x00 "), "%Y:%m:%d %H:%M:%S").timestamp())
+    except Exception as e:
+        logging.debug(f"No EXIF capture time for {path}: {e}")
+    if mime_type:
+        metadata["mime_type"] = mime_type
+    return metadata
+
+
+def preprocess_image(path, clip_processor, max_side=768, jpeg_quality=85, on_decoded=None, with_pixels=True):
+    """on_decoded(name, img), if given, also gets the decoded image (e.g. to write thumbnails from it).
+    with_pixels=False skips the ~600 KB float32 CLIP tensor; clip_pixels rebuilds it when needed"""
+    img = decode_image(path, max_side)
+    if on_decoded is not None:
+        on_decoded(path.name, img)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=jpeg_quality)
+    pixel_values = clip_processor.image_processor(images=img, return_tensors="pt")["pixel_values"][0] if with_pixels else None
+    return PreprocessedImage(path.name, buffer.getvalue(), pixel_values, img.size, dhash(img))
+
+
+def preprocess_files(files, clip_processor, max_side=768, max_workers=4, progress=None, on_decoded=None, with_pixels=True):
+    """Preprocesses files on a small thread pool (PIL releases the GIL while decoding).
+    Returns (PreprocessedImage by name, errors by name)"""
+    preprocessed, errors = {}, {}
+
+    def _work(file):
+        return preprocess_image(file, clip_processor, max_side, on_decoded=on_decoded, with_pixels=with_pixels)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for file, future in [(file, pool.submit(_work, file)) for file in files]:
+            try:
+                preprocessed[file.name] = future.result()
+            except Exception as e:
+                logging.error(f"Preprocessing failed for {file.name}: {e}")
+                errors[file.name] = str(e)
+            if progress is not None:
+                progress(len(preprocessed) + len(errors), len(files))
+    return preprocessed, errors
@@ -0,0 +1,180 @@
+"""Measures what int8 CLIP inference costs in retrieval quality and buys in speed, against fp32.
+
+A fixed set of photos and query phrases is embedded by both models. Photos are embedded the way
+the index stores them, fused with their cached captions (synthetic images get stand-in captions;
+photos without cached captions fall back to the image embedding alone). Each int8 setup is scored
+by recall@k: the share of the fp32 top-k it also retrieves. There are two setups:
+  int8                   - int8 queries against an int8 corpus (a worker that also ingests in int8)
+  int8_query_fp32_index  - int8 queries against fp32 corpus vectors (an existing index left as is)
+Queries are text (the CLIP text tower) and image (a photo's stored vector, the photo itself left out).
+Agreement of the raw image and text embeddings, per-batch latency and weight size are reported next to it.
+
+    python quantization_check.py --images photos/all --limit 500 --k 10 --min-recall 0.9
+    python quantization_check.py --synthetic 64 --clip tiny      # offline smoke run
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmark import PHRASES, _install_clip, _synthetic_images
+from config import CAPTION_IMAGE_MAX_SIDE, CLIP_BATCH_SIZE, CLIP_MODEL_NAME
+from feature_cache import content_hash
+from helpers import CAPTION_CACHE_VERSION, call_clip_model_batch, get_feature_cache
+from model_registry import configure_torch_threads, get_clip_model, clip_model_stats
+from preprocessing import decode_image
+
+EXTRA_PHRASES = ["people at a wedding", "a red car", "flowers in a garden", "a person riding a bike",
+                 "food on a table", "a group photo indoors", "the ocean from a boat", "an old building"]
+
+
+def _normalize(embeds):
+    return embeds / np.maximum(np.linalg.norm(embeds, axis=1, keepdims=True), 1e-12)
+
+
+def _embed(model, pixel_values, text_inputs, batch_size):
+    """L2-normalized image and text embeddings, and the seconds spent per image batch and per text batch"""
+    import torch
+    image_embeds, image_seconds = [], []
+    with torch.no_grad():
+        for start in range(0, len(pixel_values), batch_size):
+            batch = torch.stack(pixel_values[start:start + batch_size])
+            began = time.perf_counter()
+            image_embeds.append(model.get_image_features(pixel_values=batch).numpy())
+            image_seconds.append(time.perf_counter() - began)
+        began = time.perf_counter()
+        text_embeds = model.get_text_features(**text_inputs).numpy()
+        text_seconds = time.perf_counter() - began
+    return (_normalize(np.concatenate(image_embeds)), _normalize(text_embeds),
+            float(np.median(image_seconds)), text_seconds)
+
+
+def _fused(clip_model, pixel_values, captions, batch_size):
+    """Image + caption vectors as the index stores them"""
+    vectors = []
+    for start in range(0, len(pixel_values), batch_size):
+        end = start + batch_size
+        batch = call_clip_model_batch([None] * len(pixel_values[start:end]), captions[start:end],
+                                      pixel_values[start:end], clip_model=clip_model)
+        vectors += [vector.numpy() for vector in batch]
+    return _normalize(np.stack(vectors))
+
+
+def recall_at_k(reference_scores, scores, k, exclude_self=False):
+    """Mean share of each row's top-k under reference_scores that is also in its top-k under scores"""
+    if exclude_self:
+        reference_scores, scores = reference_scores.copy(), scores.copy()
+        np.fill_diagonal(reference_scores, -np.inf)
+        np.fill_diagonal(scores, -np.inf)
+    k = min(k, scores.shape[1] - int(exclude_self))
+    reference_top = np.argsort(-reference_scores, axis=1)[:, :k]
+    top = np.argsort(-scores, axis=1)[:, :k]
+    return float(np.mean([len(set(a) & set(b)) / k for a, b in zip(reference_top, top)]))
+
+
+def _load_images(args):
+    """The corpus images and each one's captions"""
+    if args.synthetic:
+        from PIL import Image
+        import io
+        return ([Image.open(io.BytesIO(data)).convert("RGB") for _, data in _synthetic_images(args.synthetic, 640, 480)],
+                [[PHRASES[i % len(PHRASES)], f"photo number {i}"] for i in range(args.synthetic)])
+    files = sorted(file for file in Path(args.images).iterdir() if file.is_file())[:args.limit]
+    cache = get_feature_cache()
+    images, captions = [], []
+    for file in files:
+        try:
+            images.append(decode_image(file, CAPTION_IMAGE_MAX_SIDE))
+        except Exception as e:
+            logging.warning(f"Skipping {file.name}: {e}")
+            continue
+        cached = cache.get_captions(content_hash(file), CAPTION_CACHE_VERSION) if cache is not None else None
+        captions.append(cached or [])
+    return images, captions
+
+
+def check(args):
+    images, captions = _load_images(args)
+    if len(images) < 2:
+        raise SystemExit("Need at least two images")
+    phrases = PHRASES + EXTRA_PHRASES
+    fp32_model, processor = get_clip_model(CLIP_MODEL_NAME, "fp32")
+    int8_model, _ = get_clip_model(CLIP_MODEL_NAME, "int8")
+
+    # inputs are prepared once so the timings only cover the models
+    pixel_values = [processor.image_processor(images=img, return_tensors="pt")["pixel_values"][0] for img in images]
+    text_inputs = processor(text=phrases, return_tensors="pt", padding=True)
+    embedded = {}
+    for mode, model in (("fp32", fp32_model), ("int8", int8_model)):
+        _embed(model, pixel_values[:args.batch_size], text_inputs, args.batch_size)  # warm up
+        embedded[mode] = _embed(model, pixel_values, text_inputs, args.batch_size)
+    fp32_images, fp32_texts = embedded["fp32"][:2]
+    int8_images, int8_texts = embedded["int8"][:2]
+    fp32_corpus = _fused((fp32_model, processor), pixel_values, captions, args.batch_size)
+    int8_corpus = _fused((int8_model, processor), pixel_values, captions, args.batch_size)
+
+    k = args.k
+    stats = {(entry["model_name"], entry["mode"]): entry for entry in clip_model_stats()["models"]}
+    return {
+        "images": len(images),
+        "captioned_images": sum(1 for image_captions in captions if image_captions),
+        "queries": len(phrases),
+        "k": k,
+        "batch_size": args.batch_size,
+        "latency": {mode: {"image_batch_seconds": round(embedded[mode][2], 4),
+                           "text_batch_seconds": round(embedded[mode][3], 4),
+                           "weights_mb": stats[(CLIP_MODEL_NAME, mode)]["weights_mb"]}
+                    for mode in ("fp32", "int8")},
+        "agreement": {
+            "image_cosine_mean": round(float(np.mean(np.sum(fp32_images * int8_images, axis=1))), 4),
+            "image_cosine_min": round(float(np.min(np.sum(fp32_images * int8_images, axis=1))), 4),
+            "text_cosine_mean": round(float(np.mean(np.sum(fp32_texts * int8_texts, axis=1))), 4),
+            "text_cosine_min": round(float(np.min(np.sum(fp32_texts * int8_texts, axis=1))), 4),
+        },
+        "recall_at_k": {
+            "text_to_image": {
+                "int8": recall_at_k(fp32_texts @ fp32_corpus.T, int8_texts @ int8_corpus.T, k),
+                "int8_query_fp32_index": recall_at_k(fp32_texts @ fp32_corpus.T, int8_texts @ fp32_corpus.T, k),
+            },
+            "image_to_image": {
+                "int8": recall_at_k(fp32_corpus @ fp32_corpus.T, int8_corpus @ int8_corpus.T, k, exclude_self=True),
+                "int8_query_fp32_index": recall_at_k(fp32_corpus @ fp32_corpus.T, int8_corpus @ fp32_corpus.T, k,
+                                                     exclude_self=True),
+            },
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default="photos/all", help="directory of photos to use as the corpus")
+    parser.add_argument("--limit", type=int, default=500, help="first N photos (by name) of --images")
+    parser.add_argument("--synthetic", type=int, default=0, help="use N synthetic images instead of --images")
+    parser.add_argument("--clip", choices=("tiny", "real"), default="real")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=CLIP_BATCH_SIZE)
+    parser.add_argument("--intra-op-threads", type=int, default=0)
+    parser.add_argument("--inter-op-threads", type=int, default=0)
+    parser.add_argument("--min-recall", type=float, help="exit non-zero when any recall@k falls below this")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    configure_torch_threads(args.intra_op_threads, args.inter_op_threads)
+    _install_clip(args.clip)
+    report = check(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    recalls = [value for setup in report["recall_at_k"].values() for value in setup.values()]
+    if args.min_recall is not None and min(recalls) < args.min_recall:
+        print(f"recall@{args.k} {min(recalls):.3f} is below {args.min_recall}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
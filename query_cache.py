@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+from config import QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL, QUERY_RESULT_CACHE_SIZE, QUERY_RESULT_CACHE_TTL
+
+
+def normalize_phrase(search_phrase):
+    """Case- and whitespace-insensitive cache key for a search phrase"""
+    return " ".join(search_phrase.lower().split())
+
+
+class TTLCache:
+    """Thread-safe LRU cache with a per-entry time to live and hit/miss counters.
+
+    clear() bumps a generation counter; put() calls that pass the generation
+    they read before doing their work are dropped if a clear() happened in
+    between, so a slow query can never re-populate results that were invalidated."""
+
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "invalidations": self.invalidations,
+            }
+
+
+# Process-wide caches. Embeddings only depend on the phrase and the model, so they never go stale;
+# results are cleared whenever this process commits new vectors (other workers rely on the TTL).
+embedding_cache = TTLCache(QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL)
+result_cache = TTLCache(QUERY_RESULT_CACHE_SIZE, QUERY_RESULT_CACHE_TTL)
+
+
+def invalidate_results():
+    result_cache.clear()
+
+
+def query_cache_stats():
+    return {"query_embeddings": embedding_cache.stats(), "query_results": result_cache.stats()}
@@ -1,21 +1,57 @@
-import torch
+import base64
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 from helpers import _load_clip_model
-from helpers import get_topk_records
+from helpers import get_topk_records, get_keyword_index, get_rerank_store, collapse_clusters
+from helpers import get_topk_records_many, fetch_stored_vectors, embed_query_image, user_namespace, active_generation
+from keyword_index import reciprocal_rank_fusion
+from micro_batcher import MicroBatcher
+from query_cache import embedding_cache, result_cache, normalize_phrase
+from config import QUERY_BATCH_MAX_SIZE, QUERY_BATCH_MAX_WAIT_MS, SEARCH_OVERFETCH, SEARCH_MAX_WINDOW, HYBRID_SEARCH
+from config import RERANK_CANDIDATES, RERANK_IMAGE_WEIGHT
+from metrics import span, QUERY_STAGE_SECONDS
+
+
+def encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    """Offset stored in a cursor; raises ValueError for anything that is not one of ours"""
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))["offset"]
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError("Invalid cursor")
+    return offset
+
 
 class QueryHandler:
-    def __init__(self):
-        """Initializes the QueryHandler."""
+    # shared by all handlers; keyword lookups are cheap and only need to overlap the vector query
+    _hybrid_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="keyword-search")
+
+    def __init__(self, micro_batching: bool = False):
+        """Initializes the QueryHandler with the shared, process-wide CLIP model.
+        With micro_batching, concurrent callers of generate_clip_embeddings share text forward passes."""
         self.model, self.preprocessor = _load_clip_model()
         self.model.eval()
+        self.batcher = None
+        if micro_batching:
+            self.batcher = MicroBatcher(self.encode_texts,
+                                        max_batch_size=QUERY_BATCH_MAX_SIZE,
+                                        max_wait_ms=QUERY_BATCH_MAX_WAIT_MS,
+                                        name="query-text-batcher")
 
-    def generate_clip_embeddings(self, search_phrase: str):
+    def encode_texts(self, search_phrases):
         """
-        Takes in a search phrase and generates its CLIP text embedding.
-        Normalizes the embedding for cosine similarity.
+        Encodes a list of search phrases in one padded forward pass.
+        Returns L2-normalized text embeddings, one row per phrase.
         """
+        import torch
         inputs = self.preprocessor(
-            text=search_phrase,
+            text=search_phrases,
             return_tensors="pt",
             padding=True
         )
@@ -25,16 +61,158 @@ class QueryHandler:
 
         text_embeds = text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
 
-        return text_embeds.cpu().numpy().tolist()
-    
-    def retrieve_top_k(self, q_emb, k):
+        return text_embeds.cpu().numpy()
+
+    def generate_clip_embeddings(self, search_phrase: str):
+        """
+        Takes in a search phrase and generates its CLIP text embedding.
+        Normalizes the embedding for cosine similarity.
+        Embeddings are cached by normalized phrase.
+        """
+        key = normalize_phrase(search_phrase)
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            return cached
+
+        with span("encode", QUERY_STAGE_SECONDS):
+            if self.batcher is not None:
+                text_embed = self.batcher.submit(key)
+            else:
+                text_embed = self.encode_texts([key])[0]
+
+        q_emb = [text_embed.tolist()]
+        embedding_cache.put(key, q_emb)
+        return q_emb
+
+    def search(self, search_phrase: str, k: int, filters=None, offset: int = 0, user_id=None):
+        """
+        Returns (image paths ranked [offset, offset + k), offset of the next page or None).
+        Only user_id's photos are searched; `filters` is a metadata filter both indexes apply
+        before ranking.
+        The first request over-fetches a window of results; later pages are sliced from the
+        cached window, which is only re-fetched (twice as large) when a page runs past it.
+        """
+        # keyed by index generation too, so a reindex switch never serves windows from the old one
+        key = (active_generation(), user_namespace(user_id), normalize_phrase(search_phrase),
+               repr(sorted(filters.items())) if filters else None)
+        needed = offset + k
+        window = result_cache.get(key)
+
+        if window is None or (len(window["images"]) < needed and not window["exhausted"]):
+            generation = result_cache.generation
+            previous = window["size"] if window else 0
+            size = min(SEARCH_MAX_WINDOW, max(needed * SEARCH_OVERFETCH, previous * 2))
+            images, exhausted = self.retrieve_hybrid(search_phrase, k=size, user_id=user_id, filters=filters)
+            # collapsing near-duplicates shortens the list, so it is the indexes running dry that ends paging
+            window = {"images": images, "size": size, "exhausted": exhausted or size >= SEARCH_MAX_WINDOW}
+            result_cache.put(key, window, generation=generation)
+
+        page = window["images"][offset:needed]
+        has_more = needed < len(window["images"]) or not window["exhausted"]
+        return page, (needed if has_more else None)
+
+    def retrieve_hybrid(self, search_phrase: str, k: int, user_id=None, filters=None):
+        """
+        Runs the BM25 caption query alongside the CLIP vector query and merges
+        both rankings with reciprocal-rank fusion. The vector ranking is
+        over-fetched to RERANK_CANDIDATES and re-ranked locally before fusion.
+        Results are collapsed to one image per near-duplicate cluster.
+        Falls back to vector-only ranking when HYBRID_SEARCH is off.
+        Returns (image paths, True when neither index has more matches than it returned).
+        """
+        keyword_future = None
+        if HYBRID_SEARCH:
+            keyword_future = self._hybrid_pool.submit(self._keyword_search, search_phrase, k, user_id, filters)
+
+        q_emb = self.generate_clip_embeddings(search_phrase)
+        with span("retrieve", QUERY_STAGE_SECONDS):
+            vector_k = max(k, RERANK_CANDIDATES)
+            vector_ranking = self.retrieve_top_k(q_emb=q_emb, k=vector_k, user_id=user_id, filters=filters)
+        exhausted = len(vector_ranking) < vector_k
+        with span("rerank", QUERY_STAGE_SECONDS):
+            vector_ranking = self.rerank(search_phrase, vector_ranking)
+
+        keyword_ranking = [image_path for _, image_path, _ in keyword_future.result()] if keyword_future else []
+        exhausted = exhausted and len(keyword_ranking) < k
+        ranking = reciprocal_rank_fusion([vector_ranking, keyword_ranking]) if keyword_ranking else vector_ranking
+        # near-duplicates indexed before they were clustered show up once
+        return collapse_clusters(ranking)[:k], exhausted
+
+    def _keyword_search(self, search_phrase: str, k: int, user_id=None, filters=None):
+        with span("keyword", QUERY_STAGE_SECONDS):
+            return get_keyword_index(user_id).search(search_phrase, k, filter=filters)
+
+    def rerank(self, search_phrase: str, candidates):
+        """
+        Re-scores candidates against the query with their separate image and per-caption
+        embeddings (image similarity blended with the best caption similarity).
+        Candidates without stored embeddings keep their slots; the rest are reordered
+        among the slots they occupied.
+        """
+        rerank_store = get_rerank_store()
+        if rerank_store is None or len(candidates) < 2:
+            return candidates
+
+        q_emb = self.generate_clip_embeddings(search_phrase)[0]
+        scores = rerank_store.rescore(candidates, q_emb, image_weight=RERANK_IMAGE_WEIGHT)
+        if not scores:
+            return candidates
+
+        slots = [i for i, image_path in enumerate(candidates) if image_path in scores]
+        reranked = sorted(scores, key=lambda image_path: -scores[image_path])
+        result = list(candidates)
+        for slot, image_path in zip(slots, reranked):
+            result[slot] = image_path
+        return result
+
+    def similar_to(self, image_ids, k: int, user_id=None):
+        """
+        "More like this" for already indexed images: {image_id: ranked neighbour paths}.
+        Their stored vectors are fetched in one call and queried together, so nothing is
+        re-encoded; each image is left out of its own results. Ids that are not indexed
+        in user_id's namespace are omitted. Results are cached like text searches.
+        """
+        namespace = (active_generation(), user_namespace(user_id))
+        results, pending = {}, []
+        for image_id in image_ids:
+            cached = result_cache.get(("similar", namespace, image_id, k))
+            if cached is not None:
+                results[image_id] = cached
+            else:
+                pending.append(image_id)
+        if not pending:
+            return results
+
+        generation = result_cache.generation
+        with span("fetch", QUERY_STAGE_SECONDS):
+            vectors = fetch_stored_vectors(pending, user_id)
+        found = [image_id for image_id in pending if image_id in vectors]
+        if not found:
+            return results
+        with span("retrieve", QUERY_STAGE_SECONDS):
+            # one extra for the image itself, a few more for collapsed near-duplicates
+            responses = get_topk_records_many([vectors[image_id] for image_id in found], top_k=2 * k + 1, user_id=user_id)
+        for image_id, response in zip(found, responses):
+            neighbours = [match["metadata"]["image_path"] for match in response["matches"] if match["id"] != image_id]
+            results[image_id] = collapse_clusters(neighbours)[:k]
+            result_cache.put(("similar", namespace, image_id, k), results[image_id], generation=generation)
+        return results
+
+    def similar_to_upload(self, file, k: int, user_id=None):
+        """Neighbours among user_id's photos of an image that is not indexed; only the CLIP vision tower runs, no captioning"""
+        with span("encode_image", QUERY_STAGE_SECONDS):
+            q_emb = embed_query_image(file)
+        with span("retrieve", QUERY_STAGE_SECONDS):
+            images = self.retrieve_top_k(q_emb.tolist(), k=2 * k, user_id=user_id)
+        return collapse_clusters(images)[:k]
+
+    def retrieve_top_k(self, q_emb, k, user_id=None, filters=None):
         """Retrieves top k records from pinecone db"""
-        result = get_topk_records(q_emb)['matches'] 
+        result = get_topk_records(q_emb, top_k=k, user_id=user_id, filter=filters)['matches'] 
         images_to_show_list = []
         # print(result)
         for entry in result:
             images_to_show_list.append(entry['metadata']['image_path'])
-        print(images_to_show_list)
         return images_to_show_list
         
         
@@ -0,0 +1,160 @@
+import argparse
+import logging
+import shutil
+from collections import defaultdict
+from pathlib import Path
+
+from helpers import get_manifest, get_vector_store, index_namespace, get_cluster_index, collapse_near_duplicates
+from helpers import _load_clip_model, user_namespace
+from preprocessing import preprocess_files
+from config import CAPTION_IMAGE_MAX_SIDE, PREPROCESS_WORKERS
+from ingestion_jobs import IngestionJob, run_job, clear_temp_dir
+
+TEMP_ROOT = Path("photos/recent")
+PERSIST_DIR = Path("photos/all")
+
+
+def scan(persist_dir=PERSIST_DIR, repair=False, ingestion_queue=None):
+    """Finds files in persist_dir that never made it into the vector index.
+
+    Files the manifest does not record as upserted (or as a clustered near-duplicate) are checked against the store;
+    those found there are recorded as upserted, the rest are reported missing. Files a live instance
+    or a job on ingestion_queue is still working on are reported in_progress and left alone. With
+    repair=True the missing files are handed to the next resume."""
+    manifest = get_manifest()
+    files = [file.name for file in persist_dir.iterdir() if file.is_file()] if persist_dir.exists() else []
+    states = manifest.get(files)
+    unconfirmed = [name for name in files if states.get(name) not in ("upserted", "clustered")]
+
+    owners = manifest.users(unconfirmed)
+    by_owner = defaultdict(list)
+    for name in unconfirmed:
+        by_owner[owners.get(name, [None])[0]].append(name)
+    in_index = set()
+    for user_id, names in by_owner.items():
+        in_index.update(get_vector_store().fetch(names, namespace=index_namespace(user_namespace(user_id))))
+    if in_index:
+        manifest.mark(in_index, "upserted")
+    active_jobs = ingestion_queue.active_job_ids() if ingestion_queue is not None else ()
+    in_progress = manifest.in_progress([name for name in unconfirmed if name not in in_index], active_jobs)
+    missing = [name for name in unconfirmed if name not in in_index and name not in in_progress]
+    if repair and missing:
+        manifest.mark(missing, "stored", owned=False)
+
+    logging.info(f"Reconcile: {len(files)} files, {len(in_index)} confirmed in index, "
+                 f"{len(in_progress)} in progress, {len(missing)} missing")
+    return {
+        "files": len(files),
+        "confirmed": len(in_index),
+        "missing": missing,
+        "in_progress": len(in_progress),
+        "missing_states": {name: states.get(name) for name in missing},
+        "queued_for_repair": repair,
+        "manifest": manifest.counts(),
+    }
+
+
+def prepare_resume_job(temp_root=TEMP_ROOT, persist_dir=PERSIST_DIR, include_failed=False):
+    """Claims interrupted images and gathers them into a fresh job dir, or returns None if there are none.
+    Files are moved back from persist_dir (or a dead job's temp dir) so the normal pipeline can run on them"""
+    manifest = get_manifest()
+    job = IngestionJob(temp_root, persist_dir)
+    claimed = manifest.claim_unfinished(job.id, include_failed=include_failed)
+    if not claimed:
+        return None
+
+    job.temp_dir.mkdir(parents=True, exist_ok=True)
+    found = []
+    for image_id in claimed:
+        candidates = [persist_dir / image_id, *temp_root.glob(f"*/{image_id}")]
+        source = next((path for path in candidates if path.exists() and path.parent != job.temp_dir), None)
+        if source is None:
+            manifest.mark([image_id], "failed", job_id=job.id, error="File missing on resume")
+            continue
+        shutil.move(str(source), str(job.temp_dir / image_id))
+        found.append(image_id)
+
+    # drop temp dirs left behind by jobs that died
+    for job_dir in temp_root.iterdir():
+        if job_dir.is_dir() and job_dir != job.temp_dir and not any(job_dir.iterdir()):
+            job_dir.rmdir()
+
+    if not found:
+        shutil.rmtree(job.temp_dir, ignore_errors=True)
+        return None
+    job.start_stage("store", total=len(found))
+    job.finish_stage("store", done=len(found))
+    logging.info(f"Resume job {job.id} claimed {len(found)} interrupted images")
+    return job
+
+
+def resume(ingestion_queue=None, include_failed=False):
+    """Resumes interrupted images, on the ingestion queue if given, otherwise inline"""
+    if ingestion_queue is not None:
+        ingestion_queue.reserve()
+        try:
+            job = prepare_resume_job(include_failed=include_failed)
+        except Exception:
+            ingestion_queue.release()
+            raise
+        if job is None:
+            ingestion_queue.release()
+            return None
+        return ingestion_queue.submit(job)
+
+    job = prepare_resume_job(include_failed=include_failed)
+    if job is not None:
+        try:
+            job.result = run_job(job)
+            job.status = "done"
+        finally:
+            clear_temp_dir(job)
+    return job
+
+
+def cluster_existing(persist_dir=PERSIST_DIR, batch_size=256):
+    """Backfills the near-duplicate cluster index for photos ingested before clustering existed.
+    Their vectors stay in the index; search collapses each cluster to its best ranked image"""
+    index = get_cluster_index()
+    if index is None:
+        raise RuntimeError("NEAR_DUP_ENABLED is off")
+    files = sorted(file for file in persist_dir.iterdir() if file.is_file())
+    known = index.clusters(file.name for file in files)
+    files = [file for file in files if file.name not in known]
+    owners = get_manifest().users(file.name for file in files)
+    _, processor = _load_clip_model()
+    joined = {}
+    for start in range(0, len(files), batch_size):
+        preprocessed, errors = preprocess_files(files[start:start + batch_size], processor,
+                                                CAPTION_IMAGE_MAX_SIDE, PREPROCESS_WORKERS, with_pixels=False)
+        by_user = defaultdict(dict)
+        for name, image in preprocessed.items():
+            by_user[owners.get(name, [None])[0]][name] = image
+        for user_id, images in by_user.items():
+            joined.update(collapse_near_duplicates(images, persist_dir, user_id))
+        logging.info(f"Clustered {min(start + batch_size, len(files))}/{len(files)} photos, {len(joined)} near-duplicates")
+    return {"photos": len(files), "near_duplicates": len(joined), "clusters": joined}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resume interrupted ingests and find photos missing from the index")
+    parser.add_argument("command", choices=["resume", "scan", "cluster"])
+    parser.add_argument("--repair", action="store_true", help="scan: queue missing files and resume them")
+    parser.add_argument("--include-failed", action="store_true", help="resume: also retry images that failed")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "cluster":
+        print(cluster_existing())
+        return
+    if args.command == "scan":
+        report = scan(repair=args.repair)
+        print(report)
+        if not args.repair:
+            return
+    job = resume(include_failed=args.include_failed)
+    print(job.to_dict() if job is not None else "Nothing to resume")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from config import REINDEX_WORKERS, REINDEX_BATCH_SIZE, REINDEX_CATCH_UP_PASSES
+from feature_cache import content_hash
+from helpers import (CAPTION_CACHE_VERSION, EMBEDDING_CACHE_VERSION, active_generation, set_active_generation,
+                     index_namespace, user_namespace, get_feature_cache, get_manifest, get_rerank_store,
+                     get_vector_store, push_to_pinecone)
+from query_cache import invalidate_results
+
+PERSIST_DIR = Path("photos/all")
+
+
+def _init_worker(torch_threads):
+    """Runs once per pool process: pins torch to its share of cores and loads CLIP"""
+    from helpers import _load_clip_model
+    from model_registry import configure_torch_threads
+    configure_torch_threads(torch_threads, 1)
+    _load_clip_model()
+
+
+def _embed_chunk(img_paths, img_captions_list):
+    from helpers import call_clip_model_batch
+    combined, image_embeds, text_embeds, counts = call_clip_model_batch(
+        img_paths, img_captions_list, return_components=True)
+    return ([embedding.numpy() for embedding in combined],
+            image_embeds.numpy(), text_embeds.numpy(), counts.tolist())
+
+
+def _load_captions(names, persist_dir):
+    """Captions for each file from the feature cache, falling back to the live index metadata"""
+    cache = get_feature_cache()
+    owners = get_manifest().users(names)
+    captions, hashes, missing = {}, {}, []
+    for name in names:
+        hashes[name] = content_hash(persist_dir / name)
+        cached = cache.get_captions(hashes[name], CAPTION_CACHE_VERSION) if cache is not None else None
+        if cached is not None:
+            captions[name] = cached
+        else:
+            missing.append(name)
+    if missing:
+        by_owner = {}
+        for name in missing:
+            by_owner.setdefault(user_namespace(owners.get(name, [None])[0]), []).append(name)
+        for namespace, group in by_owner.items():
+            for name, record in get_vector_store().fetch(group, namespace=index_namespace(namespace)).items():
+                if record["metadata"].get("captions"):
+                    captions[name] = list(record["metadata"]["captions"])
+    return captions, hashes
+
+
+def reindex(persist_dir=PERSIST_DIR, workers=REINDEX_WORKERS, batch_size=REINDEX_BATCH_SIZE, switch=True):
+    """Re-embeds every photo in persist_dir into a shadow index generation and switches to it.
+
+    Work is sharded in batches across a spawn-context process pool with one CLIP model per
+    worker and the machine's cores split between them. Results are upserted from the parent
+    into the shadow generation of each owner's namespace while queries keep hitting the active one. Images ingested
+    while the rebuild runs are caught up in passes until one finds none, and once more after the switch."""
+    started = time.time()
+    old_generation = active_generation()
+    generation = f"g{int(started)}"
+    rerank_store = get_rerank_store(generation)
+    cache = get_feature_cache()
+    torch_threads = max(1, (multiprocessing.cpu_count() // workers))
+    logging.info(f"Reindexing {persist_dir} into generation {generation} with {workers} workers x {torch_threads} threads")
+
+    done, skipped = set(), []
+    stats = {"generation": generation, "embedded": 0, "failed": 0, "skipped": skipped}
+
+    def _run(names):
+        captions, hashes = _load_captions(names, persist_dir)
+        skipped.extend(name for name in names if name not in captions)
+        names = [name for name in names if name in captions]
+        chunks = [names[i:i + batch_size] for i in range(0, len(names), batch_size)]
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                 initializer=_init_worker, initargs=(torch_threads,)) as pool:
+            futures = {pool.submit(_embed_chunk, [persist_dir / name for name in chunk],
+                                   [captions[name] for name in chunk]): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    combined, image_embeds, text_embeds, counts = future.result()
+                except Exception as e:
+                    logging.error(f"Reindex batch of {len(chunk)} failed: {e}")
+                    stats["failed"] += len(chunk)
+                    continue
+                records = {persist_dir / name: (captions[name], embedding) for name, embedding in zip(chunk, combined)}
+                result = push_to_pinecone(records, generation=generation)
+                if rerank_store is not None:
+                    rerank_store.add([str(persist_dir / name) for name in chunk], image_embeds, text_embeds, counts)
+                if cache is not None:
+                    for name, embedding in zip(chunk, combined):
+                        cache.put_embedding(hashes[name], EMBEDDING_CACHE_VERSION, captions[name], embedding)
+                stats["embedded"] += result["upserted"]
+                stats["failed"] += result["failed"]
+                done.update(chunk)
+                elapsed = time.time() - started
+                logging.info(f"Reindexed {stats['embedded']} images ({stats['embedded'] / elapsed:.1f} images/sec)")
+
+    _run(sorted(file.name for file in persist_dir.iterdir() if file.is_file()))
+    # images ingested (or shared) into the old generation while the rebuild ran, until a pass finds none
+    since = started
+    for _ in range(REINDEX_CATCH_UP_PASSES):
+        pass_started = time.time()
+        catch_up = get_manifest().upserted_since(since)
+        if not catch_up:
+            break
+        logging.info(f"Catching up {len(catch_up)} images ingested during the rebuild")
+        _run(catch_up)
+        since = pass_started
+
+    elapsed = time.time() - started
+    stats["seconds"] = round(elapsed, 1)
+    stats["images_per_sec"] = round(stats["embedded"] / elapsed, 2) if elapsed else None
+    if switch and stats["failed"] == 0:
+        set_active_generation(generation)
+        # ingests that read the old generation just before the switch land there; copy them over too
+        catch_up = get_manifest().upserted_since(since)
+        if catch_up:
+            logging.info(f"Catching up {len(catch_up)} images ingested during the switch")
+            _run(catch_up)
+        invalidate_results()
+        stats["switched_from"] = old_generation
+        logging.info(f"Switched index generation {old_generation or '(original)'} -> {generation}")
+    else:
+        logging.warning(f"Not switching to generation {generation} ({stats['failed']} failures)")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed the whole photo corpus into a new index generation")
+    parser.add_argument("--workers", type=int, default=REINDEX_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=REINDEX_BATCH_SIZE)
+    parser.add_argument("--no-switch", action="store_true", help="build the shadow index but keep serving the current one")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(reindex(workers=args.workers, batch_size=args.batch_size, switch=not args.no_switch))
+
+
+if __name__ == "__main__":
+    main()
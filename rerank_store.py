@@ -0,0 +1,110 @@
+import fcntl
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class RerankStore:
+    """Compact local store of the separate CLIP image and per-caption text embeddings.
+
+    Vectors are float16 rows appended to `images.f16` and `captions.f16`; `entries.jsonl`
+    maps an image path to its image row and caption row range. Matrices are written
+    before the entry that points at them, so a crash never leaves a dangling entry, and
+    appends are serialized across processes with an flock on the entries file."""
+
+    def __init__(self, root_dir, dimension=512):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.dimension = dimension
+        self.row_bytes = 2 * dimension
+        self.images_path = self.root_dir / "images.f16"
+        self.captions_path = self.root_dir / "captions.f16"
+        self.entries_path = self.root_dir / "entries.jsonl"
+        for path in (self.images_path, self.captions_path, self.entries_path):
+            path.touch(exist_ok=True)
+        self.entries = {}
+        self._offset = 0
+        self._images = self._captions = None
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def _rows(self, path):
+        return os.path.getsize(path) // self.row_bytes
+
+    def _matrix(self, path, current):
+        rows = self._rows(path)
+        if current is None or len(current) != rows:
+            if rows == 0:
+                return np.zeros((0, self.dimension), dtype=np.float16)
+            return np.memmap(path, dtype=np.float16, mode="r", shape=(rows, self.dimension))
+        return current
+
+    def _refresh(self):
+        if os.path.getsize(self.entries_path) > self._offset:
+            with open(self.entries_path) as f:
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    entry = json.loads(line)
+                    self.entries[entry["key"]] = (entry["image_row"], entry["caption_start"], entry["caption_count"])
+                    self._offset += len(line.encode())
+        self._images = self._matrix(self.images_path, self._images)
+        self._captions = self._matrix(self.captions_path, self._captions)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, keys, image_embeds, caption_embeds, counts):
+        """keys[i] owns image_embeds[i] and the next counts[i] rows of caption_embeds"""
+        image_embeds = np.asarray(image_embeds, dtype=np.float16)
+        caption_embeds = np.asarray(caption_embeds, dtype=np.float16)
+        with self._lock, open(self.entries_path, "a") as entries_file:
+            fcntl.flock(entries_file, fcntl.LOCK_EX)
+            try:
+                image_start = self._rows(self.images_path)
+                caption_start = self._rows(self.captions_path)
+                with open(self.images_path, "ab") as f:
+                    f.write(image_embeds.tobytes())
+                with open(self.captions_path, "ab") as f:
+                    f.write(caption_embeds[:sum(counts)].tobytes())
+                lines = []
+                for i, (key, count) in enumerate(zip(keys, counts)):
+                    lines.append(json.dumps({"key": key, "image_row": image_start + i,
+                                             "caption_start": caption_start, "caption_count": int(count)}) + "\n")
+                    caption_start += int(count)
+                entries_file.write("".join(lines))
+                entries_file.flush()
+            finally:
+                fcntl.flock(entries_file, fcntl.LOCK_UN)
+            self._refresh()
+
+    def rescore(self, keys, q, image_weight=0.5):
+        """Scores keys against query embedding q as
+        image_weight * sim(image) + (1 - image_weight) * max over captions sim(caption).
+        Keys without stored embeddings are left out of the result"""
+        q = np.asarray(q, dtype=np.float32).reshape(-1)
+        with self._lock:
+            self._refresh()
+            known = [key for key in keys if key in self.entries]
+            if not known:
+                return {}
+            image_rows = np.array([self.entries[key][0] for key in known])
+            image_scores = self._images[image_rows].astype(np.float32) @ q
+
+            starts = np.array([self.entries[key][1] for key in known])
+            counts = np.array([self.entries[key][2] for key in known])
+            caption_rows = np.concatenate([np.arange(s, s + c) for s, c in zip(starts, counts)]) if counts.sum() else None
+            captions = self._captions
+        caption_sims = captions[caption_rows].astype(np.float32) @ q if caption_rows is not None else None
+        # segment max over each key's caption rows; keys with no captions use the image score alone
+        caption_scores = image_scores.copy()
+        has_captions = counts > 0
+        if has_captions.any():
+            segment_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[has_captions]
+            caption_scores[has_captions] = np.maximum.reduceat(caption_sims, segment_starts)
+        scores = image_weight * image_scores + (1 - image_weight) * caption_scores
+        return dict(zip(known, scores.tolist()))
@@ -0,0 +1,33 @@
+import logging
+import os
+import uuid
+from pathlib import Path
+
+from PIL import Image
+
+# format name in URLs -> (Pillow format, media type)
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+
+def thumbnail_path(thumb_dir, image_id, size, fmt):
+    """Thumbnails are named after the content-hashed original, so a path never changes content"""
+    return Path(thumb_dir) / f"{Path(image_id).stem}-{size}.{fmt}"
+
+
+def write_thumbnails(img, image_id, thumb_dir, sizes, formats, quality=80):
+    """Writes every size (longest side, never upscaled) and format of a decoded RGB image.
+    Sizes are produced largest first, each downscaled from the previous one, and every file
+    is written under a temporary name and renamed so readers never see a partial thumbnail"""
+    thumb_dir = Path(thumb_dir)
+    thumb_dir.mkdir(parents=True, exist_ok=True)
+    current = img
+    for size in sorted(sizes, reverse=True):
+        current = current.copy()
+        current.thumbnail((size, size), Image.LANCZOS)
+        for fmt in formats:
+            pil_format, _ = FORMATS[fmt]
+            path = thumbnail_path(thumb_dir, image_id, size, fmt)
+            part_path = thumb_dir / f".{uuid.uuid4()}.part"
+            current.save(part_path, format=pil_format, quality=quality)
+            os.replace(part_path, path)
+    logging.debug(f"Wrote {len(sizes) * len(formats)} thumbnails for {image_id}")
@@ -1,25 +1,57 @@
 import logging
+from collections import defaultdict
 from pathlib import Path
 from PIL import Image
 
-from helpers import push_to_pinecone, save_locally, save_s3, load_captioning_model, perform_captioning, move_files, call_clip_model
+from helpers import push_to_pinecone, save_locally, save_s3, load_captioning_model, perform_captioning, move_files, embed_images, preprocess_images, get_manifest
+from helpers import collapse_near_duplicates, share_indexed, get_cluster_index, clip_pixels
+from config import CLIP_BATCH_SIZE
+from query_cache import invalidate_results
+from metrics import timed, IMAGES_TOTAL
 
 class UploadPipeline:
-    def  __init__(self, temp_store_dir, persist_dir):
+    def  __init__(self, temp_store_dir, persist_dir, job_id=None, user_id=None):
         self.temp_dir = temp_store_dir
         self.persist_dir = persist_dir
+        self.job_id = job_id
+        # owner of the images stored by this pipeline; later stages follow the manifest's owners
+        self.user_id = user_id
+        self.manifest = get_manifest()
+        self.caption_errors = {}
+        self.stored_files = []
+        self.duplicates = []
+        self.shared = []
+        self.preprocessed = None
+        self.preprocess_errors = {}
+        self.near_duplicates = {}
+        self.unsettled = {}
+        self.representatives = set()
         logging.info(f"UploadPipeline initialized with temp_dir={temp_store_dir}, persist_dir={persist_dir}")
         
+    @timed("store")
     def store_images(self, files, cloud_save : bool = False,):
-        """Store the uploaded image in cloud/locally, images are renamed to UUID"""
+        """Store the uploaded image in cloud/locally, images are renamed to their content hash.
+        Exact duplicates of already persisted images are skipped and listed in self.duplicates;
+        those indexed for another user are copied into this user's namespace (self.shared)"""
           
         logging.info("Backend Initiated")
         logging.info(f"Number of files to store: {len(files) if hasattr(files, '__len__') else 'unknown'}")
         
         if not(cloud_save):
             logging.info("Going with local storage")
-            self.temp_dir.mkdir(exist_ok=True)
-            save_locally(files, self.temp_dir)
+            self.temp_dir.mkdir(parents=True, exist_ok=True)
+            self.stored_files, duplicates = save_locally(files, self.temp_dir)
+            self.duplicates = [filename for filename, _ in duplicates]
+            if self.duplicates:
+                logging.info(f"Skipped {len(self.duplicates)} duplicate images: {self.duplicates}")
+                # duplicates never indexed for anyone are staged into temp_dir and ingested with the rest
+                self.shared, staged = share_indexed([content_name for _, content_name in duplicates], self.user_id,
+                                                    self.persist_dir, self.temp_dir)
+                self.stored_files += staged
+            self.manifest.mark(self.stored_files, "stored", job_id=self.job_id)
+            self.manifest.add_user(self.stored_files, self.user_id)
+            IMAGES_TOTAL.inc(len(self.stored_files), outcome="stored")
+            IMAGES_TOTAL.inc(len(self.duplicates), outcome="duplicate")
         else:
             # USE AWS S3
             logging.info("Using cloud storage (AWS S3)")
@@ -27,7 +59,85 @@ class UploadPipeline:
             
         logging.info("Uploaded Images Stored Successfully")
         
-    def run_captioning_model(self,):
+    @timed("preprocess")
+    def preprocess(self, progress=None):
+        """Decodes each stored image once (reduced-size decode, EXIF orientation applied) into
+        a downscaled JPEG, used for captioning and to build CLIP tensors batch by batch at embed time"""
+        logging.info("Initiating preprocessing")
+        self.preprocessed = preprocess_images(self.temp_dir, errors=self.preprocess_errors, progress=progress)
+        self.manifest.mark(self.preprocessed, "preprocessed", job_id=self.job_id)
+        for name, error in self.preprocess_errors.items():
+            self.manifest.mark([name], "failed", job_id=self.job_id, error=error)
+        IMAGES_TOTAL.inc(len(self.preprocess_errors), outcome="preprocess_failed")
+        logging.info(f"Preprocessed {len(self.preprocessed)} images")
+        if self.preprocess_errors:
+            logging.warning(f"Preprocessing failed for {len(self.preprocess_errors)} images: {list(self.preprocess_errors)}")
+        return self.preprocessed
+        
+    @timed("cluster")
+    def cluster_near_duplicates(self):
+        """Groups preprocessed images into near-duplicate clusters (burst shots, re-saves).
+        Images that join an existing cluster are dropped from self.preprocessed, so only the
+        cluster's representative is captioned, embedded and indexed. Images are only clustered
+        with other images of the user that first stored them; an image that other users own too
+        is still indexed for them (their searches collapse it at query time).
+        A near-duplicate is only marked "clustered" once its representative is upserted; the
+        others wait for settle_clusters at the end of the job"""
+        owners = self.manifest.users(self.preprocessed)
+        by_user = defaultdict(dict)
+        for name, image in self.preprocessed.items():
+            by_user[owners.get(name, [None])[0]][name] = image
+        joined = {}
+        for user_id, preprocessed in by_user.items():
+            joined.update(collapse_near_duplicates(preprocessed, self.persist_dir, user_id))
+        cluster_users = get_cluster_index().cluster_users(joined) if joined else {}
+        self.near_duplicates = {name: representative for name, representative in joined.items()
+                                if set(owners.get(name, [None])) == {cluster_users.get(name)}}
+        for name in self.near_duplicates:
+            self.preprocessed.pop(name, None)
+        self.representatives = set(self.preprocessed)
+        self.unsettled = dict(self.near_duplicates)
+        states = self.manifest.get(set(self.unsettled.values()))
+        self._mark_clustered([name for name, representative in self.unsettled.items()
+                              if states.get(representative) == "upserted"])
+        if self.near_duplicates:
+            logging.info(f"Collapsed {len(self.near_duplicates)} near-duplicate images into existing clusters")
+        return self.near_duplicates
+
+    def _mark_clustered(self, names):
+        self.manifest.mark(names, "clustered", job_id=self.job_id)
+        IMAGES_TOTAL.inc(len(names), outcome="near_duplicate")
+        for name in names:
+            del self.unsettled[name]
+
+    def settle_clusters(self):
+        """Called when the job ends: near-duplicates whose representative got upserted are marked
+        "clustered". If this job failed to index a representative (or it has failed before), one of
+        its near-duplicates takes its place; every near-duplicate still unsettled is released so the
+        next resume ingests it and the burst stays searchable"""
+        if not self.unsettled:
+            return
+        states = self.manifest.get(set(self.unsettled.values()))
+        self._mark_clustered([name for name, representative in self.unsettled.items()
+                              if states.get(representative) == "upserted"])
+        if not self.unsettled:
+            return
+        by_representative = defaultdict(list)
+        for name, representative in self.unsettled.items():
+            by_representative[representative].append(name)
+        for representative, names in by_representative.items():
+            if representative in self.representatives or states.get(representative) == "failed":
+                get_cluster_index().promote(names[0])
+                logging.warning(f"Representative {representative} was not indexed, promoted {names[0]} in its place")
+        by_state = defaultdict(list)
+        for name, state in self.manifest.get(self.unsettled).items():
+            by_state[state].append(name)
+        for state, names in by_state.items():
+            self.manifest.mark(names, state, job_id=self.job_id, owned=False)
+        logging.warning(f"Released {len(self.unsettled)} near-duplicates whose representative is not indexed yet")
+
+    @timed("caption")
+    def run_captioning_model(self, progress=None):
         """Runs a gemini model to generate captions for all the image stored in recent"""
         logging.info("Intiating captioning process")
         
@@ -41,8 +151,15 @@ class UploadPipeline:
         model = load_captioning_model()
         logging.info("Captioning model loaded successfully")
         
-        img_caption_pairs = perform_captioning(model, self.temp_dir)
+        img_caption_pairs = perform_captioning(model, self.temp_dir, errors=self.caption_errors, progress=progress,
+                                               preprocessed=self.preprocessed)
         logging.info(f"Generated captions for {len(img_caption_pairs)} images")
+        self.manifest.mark(img_caption_pairs, "captioned", job_id=self.job_id)
+        for name, error in self.caption_errors.items():
+            self.manifest.mark([name], "failed", job_id=self.job_id, error=error)
+        IMAGES_TOTAL.inc(len(self.caption_errors), outcome="caption_failed")
+        if self.caption_errors:
+            logging.warning(f"Captioning failed for {len(self.caption_errors)} images: {list(self.caption_errors)}")
         
         logging.info("Emptying recent dir")
         move_files(self.temp_dir, self.persist_dir)
@@ -51,34 +168,47 @@ class UploadPipeline:
         logging.info("Terminating Captioning Process")
         return img_caption_pairs
     
-    def run_emebedding_model(self, img_caption_pairs):
-        """Takes in image and it's caption and runs clip model to generate embeddings, aggregrating the final embedding into one"""
+    @timed("embed")
+    def run_emebedding_model(self, img_caption_pairs, batch_size : int = CLIP_BATCH_SIZE, progress=None):
+        """Takes in image and it's caption and runs clip model to generate embeddings, aggregrating the final embedding into one.
+        Images are embedded batch_size at a time in a single forward pass, skipping any already in the feature cache"""
         img_caption_emb_pairs = {}
         logging.info("Initiating Embedding Creation")
-        logging.info(f"Processing {len(img_caption_pairs)} image-caption pairs")
+        logging.info(f"Processing {len(img_caption_pairs)} image-caption pairs in batches of {batch_size}")
         
-        for idx, key in enumerate(img_caption_pairs, 1):
-            img_path = self.persist_dir / key
-            img_captions = img_caption_pairs[key]
-            
-            logging.debug(f"[{idx}/{len(img_caption_pairs)}] Processing: {key}")
-            logging.debug(f"  Image path: {img_path}")
-            logging.debug(f"  Captions: {img_captions}")
+        keys = list(img_caption_pairs)
+        for start in range(0, len(keys), batch_size):
+            batch_keys = keys[start:start + batch_size]
+            img_paths = [self.persist_dir / key for key in batch_keys]
+            batch_captions = [img_caption_pairs[key] for key in batch_keys]
             
-            aggregate_embedding = call_clip_model(img_path, img_captions)
+            logging.debug(f"[{start + len(batch_keys)}/{len(keys)}] Processing batch: {batch_keys}")
+            logging.debug(f"  Captions: {batch_captions}")
             
-            logging.debug(f"  Embedding shape: {aggregate_embedding.shape if hasattr(aggregate_embedding, 'shape') else 'unknown'}")
+            batch_pixels = None
+            if self.preprocessed is not None and all(key in self.preprocessed for key in batch_keys):
+                batch_pixels = clip_pixels([self.preprocessed[key] for key in batch_keys])
+            aggregate_embeddings = embed_images(img_paths, batch_captions, batch_pixels)
             
-            img_caption_emb_pairs[img_path] = [
-                img_captions,
-                aggregate_embedding
-            ]
+            for img_path, img_captions, aggregate_embedding in zip(img_paths, batch_captions, aggregate_embeddings):
+                logging.debug(f"  Embedding shape for {img_path}: {aggregate_embedding.shape if hasattr(aggregate_embedding, 'shape') else 'unknown'}")
+                img_caption_emb_pairs[img_path] = [
+                    img_captions,
+                    aggregate_embedding
+                ]
+            if progress is not None:
+                progress(len(img_caption_emb_pairs), len(keys))
             
         logging.info(f"Created embeddings for {len(img_caption_emb_pairs)} images")
+        self.manifest.mark([img_path.name for img_path in img_caption_emb_pairs], "embedded", job_id=self.job_id)
         logging.info("Terminating Embedding Creation")
+        # the tensors are no longer needed once embeddings exist
+        self.preprocessed = None
         return img_caption_emb_pairs
         
+    @timed("upsert")
     def push_to_vector_db(self, img_caption_emb_pairs):
+        """Upserts the embeddings, returns {'upserted': n, 'failed': n, 'failed_ids': [...]}"""
         logging.info("Initiating Vector DB operations")
         logging.info(f"Preparing to push {len(img_caption_emb_pairs)} records to Pinecone")
         
@@ -95,14 +225,31 @@ class UploadPipeline:
                 logging.debug(f"  Embedding shape: {sample_value[1].shape}")
         
         try:
-            push_to_pinecone(img_caption_emb_pairs)
-            logging.info("Successfully pushed vectors to Pinecone")
+            result = push_to_pinecone(img_caption_emb_pairs)
         except Exception as e:
             logging.error(f"Exception Happened: {e}")
             logging.error(f"Exception type: {type(e).__name__}")
             import traceback
             logging.debug("Full traceback:")
             logging.debug(traceback.format_exc())
+            IMAGES_TOTAL.inc(len(img_caption_emb_pairs), outcome="upsert_failed")
+            return {"upserted": 0, "failed": len(img_caption_emb_pairs),
+                    "failed_ids": [img_path.name for img_path in img_caption_emb_pairs]}
+        
+        failed_ids = set(result["failed_ids"])
+        self.manifest.mark([img_path.name for img_path in img_caption_emb_pairs if img_path.name not in failed_ids],
+                           "upserted", job_id=self.job_id)
+        for image_id in failed_ids:
+            self.manifest.mark([image_id], "embedded", job_id=self.job_id, error="Vector DB upsert failed")
+        IMAGES_TOTAL.inc(result["upserted"], outcome="upserted")
+        IMAGES_TOTAL.inc(result["failed"], outcome="upsert_failed")
+        if result["upserted"]:
+            invalidate_results()
+        if result["failed"]:
+            logging.error(f"Failed to push {result['failed']} vectors: {result['failed_ids']}")
+        else:
+            logging.info("Successfully pushed vectors to Pinecone")
+        return result
 
 # temp_dir = Path('photos//recent')
 # persist_dir = Path('photos//all')
@@ -0,0 +1,473 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+_FILTER_OPS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$exists": lambda value, operand: (value is not None) == operand,
+}
+
+
+def matches_filter(metadata, filter):
+    """Evaluates a Pinecone metadata filter against one record's metadata.
+    Supports the comparison operators in _FILTER_OPS, $and / $or, and bare values as $eq"""
+    metadata = metadata or {}
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, sub) for sub in condition):
+                return False
+        else:
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            value = metadata.get(key)
+            if not all(_FILTER_OPS[op](value, operand) for op, operand in condition.items()):
+                return False
+    return True
+
+
+class VectorStore:
+    """Minimal vector store interface; query results are shaped like Pinecone's
+    ({'matches': [{'id', 'score', 'metadata'}]}) so callers work against either backend"""
+
+    def upsert(self, vectors, namespace="__default__"):
+        """Returns {'upserted': n, 'failed': n, 'failed_ids': [...]}"""
+        raise NotImplementedError
+
+    def query(self, vector, top_k=5, namespace="__default__", include_metadata=True, filter=None):
+        """Top matches among the records whose metadata passes `filter` (Pinecone filter syntax);
+        the filter is applied before ranking, so top_k matches are returned whenever that many pass"""
+        raise NotImplementedError
+
+    def query_many(self, vectors, top_k=5, namespace="__default__", include_metadata=True, filter=None):
+        """One query result per vector, in order"""
+        return [self.query(vector, top_k, namespace, include_metadata, filter) for vector in vectors]
+
+    def fetch(self, ids, namespace="__default__"):
+        """Stored vectors by id: {id: {'values': [...], 'metadata': {...}}}; unknown ids are omitted"""
+        raise NotImplementedError
+
+    def delete(self, ids, namespace="__default__"):
+        raise NotImplementedError
+
+
+class PineconeVectorStore(VectorStore):
+    """Remote Pinecone index.
+
+    The index handle is created once and reused for the life of the process.
+    Upserts are split into chunks sent over a small thread pool; a failed chunk is
+    retried on its own, which is safe because vector ids are content hashes."""
+    def __init__(self, pc, index_name, index_host, dimension=512,
+                 upsert_batch_size=100, upsert_workers=4, upsert_retries=3):
+        self.pc = pc
+        self.index_name = index_name
+        self.index_host = index_host
+        self.dimension = dimension
+        self.upsert_batch_size = upsert_batch_size
+        self.upsert_workers = upsert_workers
+        self.upsert_retries = upsert_retries
+        self._handle = None
+        self._handle_lock = threading.Lock()
+
+    def _ensure_index(self):
+        from pinecone import ServerlessSpec
+        existing_names = [idx['name'] for idx in self.pc.list_indexes()]
+        if self.index_name not in existing_names:
+            self.pc.create_index(
+                name=self.index_name,
+                dimension=self.dimension,
+                metric="cosine",
+                spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+                deletion_protection="disabled"
+            )
+            print("INDEX CREATED")
+        else:
+            print("Index already exists, skipping creation.")
+
+    def _index(self, create=False):
+        """Cached index handle; with create=True the index is created first if missing"""
+        if self._handle is None:
+            with self._handle_lock:
+                if self._handle is None:
+                    if create:
+                        self._ensure_index()
+                        self._handle = self.pc.Index(self.index_name)
+                    else:
+                        self._handle = self.pc.Index(host=self.index_host)
+        return self._handle
+
+    def _upsert_chunk(self, chunk, namespace):
+        index = self._index(create=True)
+        for attempt in range(self.upsert_retries + 1):
+            try:
+                index.upsert(vectors=chunk, namespace=namespace)
+                return
+            except Exception as e:
+                if attempt == self.upsert_retries:
+                    raise
+                delay = min(10.0, 0.5 * 2 ** attempt)
+                logging.warning(f"Upsert of {len(chunk)} vectors failed ({e}), retry {attempt + 1}/{self.upsert_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def upsert(self, vectors, namespace="__default__"):
+        """Returns {'upserted': n, 'failed': n, 'failed_ids': [...]}"""
+        result = {"upserted": 0, "failed": 0, "failed_ids": []}
+        if not vectors:
+            return result
+        self._index(create=True)
+        chunks = [vectors[i:i + self.upsert_batch_size] for i in range(0, len(vectors), self.upsert_batch_size)]
+        with ThreadPoolExecutor(max_workers=min(self.upsert_workers, len(chunks))) as pool:
+            futures = {pool.submit(self._upsert_chunk, chunk, namespace): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    future.result()
+                    result["upserted"] += len(chunk)
+                except Exception as e:
+                    logging.error(f"Upsert of {len(chunk)} vectors failed after retries: {e}")
+                    result["failed"] += len(chunk)
+                    result["failed_ids"].extend(v["id"] for v in chunk)
+        return result
+
+    def query(self, vector, top_k=5, namespace="__default__", include_metadata=True, filter=None):
+        kwargs = {"filter": filter} if filter else {}
+        return self._index().query(
+                    namespace=namespace,
+                    vector=vector,
+                    top_k=top_k,
+                    include_metadata=include_metadata,
+                    include_values=False,
+                    **kwargs
+                )
+
+    def query_many(self, vectors, top_k=5, namespace="__default__", include_metadata=True, filter=None):
+        """Pinecone has no multi-vector query, so the queries share the upsert thread pool"""
+        vectors = list(vectors)
+        if len(vectors) < 2:
+            return super().query_many(vectors, top_k, namespace, include_metadata, filter)
+        with ThreadPoolExecutor(max_workers=min(self.upsert_workers, len(vectors))) as pool:
+            return list(pool.map(lambda vector: self.query(vector, top_k, namespace, include_metadata, filter), vectors))
+
+    def fetch(self, ids, namespace="__default__"):
+        ids = list(ids)
+        found = {}
+        # ids travel in the request URL, so keep each call small
+        for i in range(0, len(ids), 100):
+            response = self._index().fetch(ids=ids[i:i + 100], namespace=namespace)
+            for vec_id, vector in response.vectors.items():
+                found[vec_id] = {"values": list(vector.values), "metadata": dict(vector.metadata or {})}
+        return found
+
+    def delete(self, ids, namespace="__default__"):
+        self._index().delete(ids=list(ids), namespace=namespace)
+
+
+class IVFIndex:
+    """Inverted-file approximate index: vectors are bucketed under k-means centroids
+    and a query only scores the buckets of its `nprobe` nearest centroids"""
+    def __init__(self, n_lists, nprobe, n_iter=10, seed=0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+        self.list_of = {}
+        self.trained_size = 0
+
+    def train(self, matrix, live_rows):
+        rng = np.random.default_rng(self.seed)
+        data = matrix[live_rows]
+        n_lists = min(self.n_lists, len(live_rows))
+        centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = data[assign == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+        self.centroids = centroids
+        assign = np.argmax(data @ centroids.T, axis=1)
+        self.lists = [list(live_rows[assign == c]) for c in range(n_lists)]
+        self.list_of = {int(row): int(c) for row, c in zip(live_rows, assign)}
+        self.trained_size = len(live_rows)
+
+    def add(self, rows, vectors):
+        """Buckets new rows; a row updated in place moves from its old vector's bucket to the new one's"""
+        assign = np.argmax(vectors @ self.centroids.T, axis=1)
+        for row, c in zip(rows, assign):
+            row, c = int(row), int(c)
+            previous = self.list_of.get(row)
+            if previous == c:
+                continue
+            if previous is not None:
+                self.lists[previous].remove(row)
+            self.lists[c].append(row)
+            self.list_of[row] = c
+
+    def candidates(self, q):
+        probe = np.argsort(-(self.centroids @ q))[:self.nprobe]
+        rows = [row for c in probe for row in self.lists[c]]
+        return np.unique(np.asarray(rows, dtype=np.int64))
+
+
+class LocalVectorStore(VectorStore):
+    """Embedded cosine-similarity store backed by a memory-mapped float32 matrix.
+
+    Each namespace lives in its own directory holding `vectors.f32` (row-major,
+    `dimension` floats per row) and `meta.jsonl`, an append-only id -> row/metadata
+    log. Several processes may share a directory: writes are serialized with an flock
+    and each process replays the log's new entries before using a namespace. Queries are exact brute-force matrix products until the
+    namespace holds `ivf_threshold` live vectors, after which an IVF index is
+    trained and used instead."""
+
+    def __init__(self, root_dir, dimension=512, ivf_threshold=20000, ivf_lists=None, ivf_nprobe=8):
+        self.root_dir = Path(root_dir)
+        self.dimension = dimension
+        self.ivf_threshold = ivf_threshold
+        self.ivf_lists = ivf_lists
+        self.ivf_nprobe = ivf_nprobe
+        self._namespaces = {}
+        self._lock = threading.RLock()
+
+    def _namespace(self, namespace):
+        ns = self._namespaces.get(namespace)
+        if ns is None:
+            ns = _Namespace(self.root_dir / namespace, self.dimension)
+            self._namespaces[namespace] = ns
+        else:
+            ns.refresh()
+        return ns
+
+    def _ivf(self, ns):
+        live = ns.live_rows()
+        if len(live) < self.ivf_threshold:
+            return None
+        # retrain when the corpus has doubled since the last training run
+        if ns.ivf is None or len(live) >= 2 * ns.ivf.trained_size:
+            n_lists = self.ivf_lists or int(np.sqrt(len(live)))
+            ns.ivf = IVFIndex(n_lists, self.ivf_nprobe)
+            ns.ivf.train(ns.matrix, live)
+            ns.ivf_pending = []
+            logging.info(f"Trained IVF index with {n_lists} lists over {len(live)} vectors")
+        elif ns.ivf_pending:
+            rows = np.asarray(ns.ivf_pending, dtype=np.int64)
+            ns.ivf.add(rows, ns.matrix[rows])
+            ns.ivf_pending = []
+        return ns.ivf
+
+    def upsert(self, vectors, namespace="__default__"):
+        with self._lock:
+            ns = self._namespace(namespace)
+            ns.upsert(vectors)
+            return {"upserted": len(vectors), "failed": 0, "failed_ids": []}
+
+    def query(self, vector, top_k=5, namespace="__default__", include_metadata=True, filter=None):
+        """Filtered rows are dropped before scoring. With IVF the filter applies to the probed
+        buckets, falling back to an exact scan of every passing row when the probe comes up short"""
+        q = np.asarray(vector, dtype=np.float32).reshape(-1)
+        q = q / (np.linalg.norm(q) or 1.0)
+        with self._lock:
+            ns = self._namespace(namespace)
+            if ns.size == 0:
+                return {"matches": [], "namespace": namespace}
+            ivf = self._ivf(ns)
+            rows = ivf.candidates(q) if ivf is not None else ns.live_rows()
+            rows = ns.filter_rows(rows[ns.alive[rows]], filter)
+            if ivf is not None and filter and len(rows) < top_k:
+                rows = ns.filter_rows(ns.live_rows(), filter)
+            return self._matches(ns, rows, ns.matrix[rows] @ q, top_k, include_metadata, namespace)
+
+    def query_many(self, vectors, top_k=5, namespace="__default__", include_metadata=True, filter=None):
+        """Scores every query against the corpus in a single matrix product when the namespace is
+        brute-forced (IVF namespaces fall back to one probe per query)"""
+        queries = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            ns = self._namespace(namespace)
+            if ns.size == 0 or len(queries) == 0:
+                return [{"matches": [], "namespace": namespace} for _ in queries]
+            if self._ivf(ns) is not None:
+                return [self.query(q, top_k, namespace, include_metadata, filter) for q in queries]
+            rows = ns.filter_rows(ns.live_rows(), filter)
+            scores = ns.matrix[rows] @ queries.T
+            return [self._matches(ns, rows, scores[:, j], top_k, include_metadata, namespace)
+                    for j in range(len(queries))]
+
+    @staticmethod
+    def _matches(ns, rows, scores, top_k, include_metadata, namespace):
+        top = np.argsort(-scores)[:top_k] if len(rows) > top_k else np.argsort(-scores)
+        matches = []
+        for i in top:
+            row = int(rows[i])
+            match = {"id": ns.ids[row], "score": float(scores[i])}
+            if include_metadata:
+                match["metadata"] = ns.metadata[row]
+            matches.append(match)
+        return {"matches": matches, "namespace": namespace}
+
+    def fetch(self, ids, namespace="__default__"):
+        with self._lock:
+            ns = self._namespace(namespace)
+            found = {}
+            for vec_id in ids:
+                row = ns.row_of.get(vec_id)
+                if row is not None:
+                    found[vec_id] = {"values": ns.matrix[row].tolist(), "metadata": ns.metadata[row]}
+            return found
+
+    def delete(self, ids, namespace="__default__"):
+        with self._lock:
+            self._namespace(namespace).delete(ids)
+
+
+class _Namespace:
+    """One namespace's files. Writers in any process hold an flock on meta.jsonl while they
+    assign rows and append, after replaying the entries other processes appended; readers
+    replay new entries before each operation, so every process sees the same rows."""
+
+    def __init__(self, path, dimension):
+        self.path = path
+        self.dimension = dimension
+        self.row_bytes = 4 * dimension
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.path / "vectors.f32"
+        self.meta_path = self.path / "meta.jsonl"
+        self.vectors_path.touch(exist_ok=True)
+        self.meta_path.touch(exist_ok=True)
+        self.ids, self.metadata, self.row_of = [], [], {}
+        self.ivf, self.ivf_pending = None, []
+        self._offset = 0
+        self._remap()
+        self.refresh()
+
+    @property
+    def size(self):
+        return len(self.ids)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.meta_path, "a") as meta_file:
+            fcntl.flock(meta_file, fcntl.LOCK_EX)
+            try:
+                yield meta_file
+            finally:
+                fcntl.flock(meta_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """Replays the meta.jsonl entries appended since the last replay, by this or another process"""
+        if os.path.getsize(self.meta_path) <= self._offset:
+            return
+        first_new = len(self.ids)
+        updated = []
+        with open(self.meta_path) as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                self._offset += len(line.encode())
+                entry = json.loads(line)
+                if entry.get("deleted"):
+                    row = self.row_of.pop(entry["id"], None)
+                    if row is not None:
+                        self.metadata[row] = None
+                    continue
+                row = entry["row"]
+                while len(self.ids) <= row:
+                    self.ids.append(None)
+                    self.metadata.append(None)
+                if row < first_new:
+                    updated.append(row)
+                previous = self.ids[row]
+                if previous is not None and previous != entry["id"] and self.row_of.get(previous) == row:
+                    del self.row_of[previous]
+                self.ids[row] = entry["id"]
+                self.metadata[row] = entry.get("metadata", {})
+                self.row_of[entry["id"]] = row
+        # rows rewritten in place are re-bucketed too, or queries would probe their old vector's list
+        self.ivf_pending.extend(updated)
+        self.ivf_pending.extend(range(first_new, len(self.ids)))
+        self._remap()
+
+    def _remap(self):
+        # a writer that crashed between its two appends can leave meta rows without vectors; they stay dead
+        n_rows = min(len(self.ids), os.path.getsize(self.vectors_path) // self.row_bytes)
+        if n_rows:
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(n_rows, self.dimension))
+        else:
+            self.matrix = np.zeros((0, self.dimension), dtype=np.float32)
+        self.alive = np.array([row < n_rows and i is not None and self.row_of.get(i) == row
+                               for row, i in enumerate(self.ids)], dtype=bool)
+
+    def live_rows(self):
+        return np.flatnonzero(self.alive)
+
+    def filter_rows(self, rows, filter):
+        """The rows whose metadata passes a metadata filter"""
+        if not filter:
+            return rows
+        return rows[np.fromiter((matches_filter(self.metadata[row], filter) for row in rows), dtype=bool, count=len(rows))]
+
+    def upsert(self, vectors):
+        with self._locked() as meta_file:
+            self.refresh()
+            # vectors a crashed writer appended without their meta entries are dropped, and
+            # new rows start right after the last row the log knows about
+            n_rows = len(self.ids)
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(n_rows * self.row_bytes)
+            new_values, updated = [], []
+            pending = {}
+            log = []
+            for v in vectors:
+                values = np.asarray(v["values"], dtype=np.float32).reshape(-1)
+                values = values / (np.linalg.norm(values) or 1.0)
+                row = self.row_of.get(v["id"], pending.get(v["id"]))
+                if row is None:
+                    row = n_rows + len(new_values)
+                    pending[v["id"]] = row
+                    new_values.append(values)
+                elif row >= n_rows:
+                    # same id twice in one batch, the later vector wins
+                    new_values[row - n_rows] = values
+                else:
+                    updated.append((row, values))
+                log.append({"id": v["id"], "row": row, "metadata": v.get("metadata", {})})
+
+            self._remap()
+            for row, values in updated:
+                self.matrix[row] = values
+            if updated:
+                self.matrix.flush()
+            if new_values:
+                with open(self.vectors_path, "ab") as f:
+                    f.write(np.stack(new_values).astype(np.float32).tobytes())
+            meta_file.write("".join(json.dumps(entry) + "\n" for entry in log))
+            meta_file.flush()
+        self.refresh()
+
+    def delete(self, ids):
+        with self._locked() as meta_file:
+            self.refresh()
+            meta_file.write("".join(json.dumps({"id": vec_id, "deleted": True}) + "\n"
+                                    for vec_id in ids if vec_id in self.row_of))
+            meta_file.flush()
+        self.refresh()